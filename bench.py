@@ -0,0 +1,390 @@
+#!/usr/bin/python
+
+"""rough benchmarks for the epub module
+
+usage: python bench.py [name ...]
+"""
+
+import epub
+import os
+import sys
+import tempfile
+import time
+import zipfile
+
+
+SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_files/sample_file.epub")
+
+
+def makeBook(path, items=2000, size=2000):
+    """write a synthetic epub with a manifest/spine of `items` xhtml files"""
+    body = ("<p>" + "lorem ipsum dolor sit amet " * (size // 27) + "</p>\n")
+    manifest = []
+    spine = []
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr(zipfile.ZipInfo("mimetype"), "application/epub+zip", zipfile.ZIP_STORED)
+        z.writestr("META-INF/container.xml",
+                   '<?xml version="1.0"?><container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+                   '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles></container>')
+        for i in range(items):
+            name = "Text/chapter%05d.xhtml" % i
+            z.writestr("OEBPS/" + name,
+                       '<?xml version="1.0" encoding="utf-8"?><html xmlns="http://www.w3.org/1999/xhtml"><head><title>%d</title></head>'
+                       '<body><h1 id="c%d">Chapter %d</h1>%s<a href="chapter%05d.xhtml#c%d">next</a></body></html>' % (i, i, i, body, (i + 1) % items, (i + 1) % items))
+            manifest.append('<item href="%s" id="c%d" media-type="application/xhtml+xml" />' % (name, i))
+            spine.append('<itemref idref="c%d" />' % i)
+        z.writestr("OEBPS/content.opf",
+                   '<?xml version="1.0" encoding="utf-8"?><package xmlns="http://www.idpf.org/2007/opf" unique-identifier="BookId" version="2.0">'
+                   '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">'
+                   '<dc:identifier id="BookId" opf:scheme="UUID">urn:uuid:bench</dc:identifier><dc:title>Bench</dc:title>'
+                   '<dc:creator opf:role="aut">Author</dc:creator><dc:language>en</dc:language><meta name="cover" content="c0" />'
+                   '</metadata><manifest>%s</manifest><spine>%s</spine></package>' % ("".join(manifest), "".join(spine)))
+    return path
+
+
+def timeit(func, repeat=200):
+    """best-of-three average seconds per call"""
+    best = None
+    for run in range(3):
+        start = time.perf_counter()
+        for i in range(repeat):
+            func()
+        took = (time.perf_counter() - start) / repeat
+        if best is None or took < best:
+            best = took
+    return best
+
+
+def report(name, seconds, baseline=None):
+    line = "%-40s %10.1f us" % (name, seconds * 1e6)
+    if baseline:
+        line += "   x%.1f" % (baseline / seconds)
+    print(line)
+
+
+def bench_meta():
+    """full open vs metadata-only open of the sample book"""
+    def full():
+        info = epub.epubInfo(SAMPLE)
+        dict((name, info.meta.getMetaData(name)) for name in info.meta.templates)
+        info.close()
+
+    def meta():
+        epub.readMetadata(SAMPLE)
+
+    base = timeit(full)
+    report("epubInfo(path) + getMetaData", base)
+    report("readMetadata(path)", timeit(meta), base)
+
+    big = makeBook(os.path.join(tempfile.mkdtemp(), "big.epub"))
+
+    def bigFull():
+        info = epub.epubInfo(big)
+        dict((name, info.meta.getMetaData(name)) for name in info.meta.templates)
+        info.close()
+
+    def bigMeta():
+        epub.readMetadata(big)
+
+    base = timeit(bigFull, 5)
+    report("epubInfo(path) 2000 items", base)
+    report("readMetadata(path) 2000 items", timeit(bigMeta, 5), base)
+
+
+def bench_cache():
+    """metadata-only open with and without a warm metaCache"""
+    cache = epub.metaCache(os.path.join(tempfile.mkdtemp(), "cache.db"))
+
+    def plain():
+        epub.readMetadata(SAMPLE)
+
+    def cached():
+        epub.readMetadata(SAMPLE, cache)
+
+    base = timeit(plain)
+    report("readMetadata(path)", base)
+    report("readMetadata(path, cache)", timeit(cached), base)
+    print(cache.stats())
+    cache.close()
+
+
+def bench_memory():
+    """memory held by an open book with many entries"""
+    import gc
+    import tracemalloc
+    big = makeBook(os.path.join(tempfile.mkdtemp(), "many.epub"), items=20000, size=50)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    info = epub.epubInfo(big)
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print("%-40s %10.1f KiB" % ("epubInfo(path) 20000 items", held / 1024.0))
+    print("%-40s %10.1f B" % ("per item", float(held) / len(info.contentsArr)))
+    info.close()
+
+
+def bench_readcache():
+    """re-reading the spine of a book with and without an itemCache"""
+    big = makeBook(os.path.join(tempfile.mkdtemp(), "chapters.epub"), items=50, size=50000)
+    plain = epub.epubInfo(big)
+    cache = epub.itemCache(64 * 1024 * 1024)
+    cached = epub.epubInfo(big, readCache=cache)
+
+    def readAll(info):
+        for item in info.opf.spine:
+            item.read()
+
+    base = timeit(lambda: readAll(plain), 20)
+    report("spine read() x50 chapters", base)
+    report("spine read() x50 chapters, itemCache", timeit(lambda: readAll(cached), 20), base)
+    print(cache.stats())
+    plain.close()
+    cached.close()
+
+
+def bench_save():
+    """fixing one metadata field: extract and rezip everything vs copy-on-write save()"""
+    import shutil
+    tmp = tempfile.mkdtemp()
+    big = makeBook(os.path.join(tmp, "fix.epub"), items=2000, size=20000)
+
+    def rezip():
+        extracted = tempfile.mkdtemp(dir=tmp)
+        with zipfile.ZipFile(big) as archive:
+            archive.extractall(extracted)
+            names = [member.filename for member in archive.infolist()]
+        with zipfile.ZipFile(os.path.join(tmp, "rezip.epub"), "w") as out:
+            for name in names:
+                out.write(os.path.join(extracted, name), name, zipfile.ZIP_STORED if name == "mimetype" else zipfile.ZIP_DEFLATED)
+        shutil.rmtree(extracted)
+
+    def save():
+        book = epub.epubFile(big, openFor="w")
+        book.info.setMetaData("title", "Fixed")
+        book.save(os.path.join(tmp, "saved.epub"))
+        book.info.close()
+
+    base = timeit(rezip, 2)
+    report("extractall + rezip 2000 items", base)
+    report("setMetaData + save() 2000 items", timeit(save, 2), base)
+
+
+def bench_toc():
+    """"which chapter is this item in": walking the toc tree vs NCX.locate()"""
+    big = makeBook(os.path.join(tempfile.mkdtemp(), "toc.epub"), items=2000, size=50)
+    with zipfile.ZipFile(big, "a") as z:
+        points = "".join('<navPoint id="p%d" playOrder="%d"><navLabel><text>Chapter %d</text></navLabel>'
+                         '<content src="Text/chapter%05d.xhtml"/></navPoint>' % (i, i + 1, i, i) for i in range(0, 2000, 10))
+        z.writestr("OEBPS/toc.ncx", '<?xml version="1.0"?><ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">'
+                                    '<navMap>%s</navMap></ncx>' % points)
+    info = epub.epubInfo(big)
+    info.ncx = epub.NCX("OEBPS/toc.ncx", info.contents, None, info.opf.spine)
+    target = info.opf.spine[1995]
+
+    position = dict((item, i) for i, item in enumerate(info.opf.spine))
+
+    def walk():
+        found = None
+        for entry in info.ncx:
+            if position.get(entry.item, -1) <= position[target] and (found is None or position[entry.item] > position[found.item]):
+                found = entry
+        return found
+
+    def locate():
+        return info.ncx.locate(target)
+
+    assert walk() is locate()
+    base = timeit(walk, 2)
+    report("toc tree walk", base)
+    report("NCX.locate()", timeit(locate), base)
+    info.close()
+
+
+def bench_text():
+    """peak memory extracting the text of a book with huge chapters: read() + strip vs iterText()"""
+    import re
+    import tracemalloc
+    big = makeBook(os.path.join(tempfile.mkdtemp(), "huge.epub"), items=4, size=2 * 1024 * 1024)
+    info = epub.epubInfo(big)
+
+    def stripped():
+        for item in info.opf.spine:
+            len(re.sub(r"<[^>]*>", " ", item.read().decode("utf-8")).split())
+
+    def streamed():
+        for block in info.iterText():
+            len(block.text.split())
+
+    for name, func in (("read() + re.sub", stripped), ("iterText()", streamed)):
+        tracemalloc.start()
+        start = time.perf_counter()
+        func()
+        took = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print("%-40s %10.1f ms %10.1f KiB peak" % (name, took * 1e3, peak / 1024.0))
+    info.close()
+
+
+def bench_textindex():
+    """phrase search over 50 books: reopening every book and scanning its text vs a saved textIndex"""
+    import shutil
+    library = tempfile.mkdtemp()
+    book = makeBook(os.path.join(library, "book0.epub"), items=20, size=2000)
+    for i in range(1, 50):
+        shutil.copy(book, os.path.join(library, "book%d.epub" % i))
+    paths = sorted(os.path.join(library, name) for name in os.listdir(library))
+
+    def scan():
+        found = []
+        for path in paths:
+            info = epub.epubInfo(path)
+            found.extend((path, block.item.rootRelLoc) for block in info.iterText() if "chapter 7" in block.text.lower())
+            info.close()
+        return found
+
+    index = epub.textIndex(os.path.join(library, "index.epix"))
+    start = time.perf_counter()
+    for path in paths:
+        index.addBook(path)
+    index.save()
+    print("%-40s %10.1f ms" % ("textIndex build + save", (time.perf_counter() - start) * 1e3))
+
+    base = timeit(scan, 1)
+    report("reopen + iterText 50 books", base)
+    report("textIndex.search()", timeit(lambda: index.search("chapter 7"), 20), base)
+    report("textIndex.prefix()", timeit(lambda: index.prefix("chapt"), 20), base)
+    print(index.stats())
+    index.close()
+
+
+def bench_threads():
+    """decompressing a whole book from one epubInfo with 1..8 threads"""
+    import concurrent.futures
+    big = makeBook(os.path.join(tempfile.mkdtemp(), "threads.epub"), items=64, size=1024 * 1024)
+    info = epub.epubInfo(big)
+    items = list(info.opf.spine)
+    total = sum(item.file_size for item in items)
+    archive = zipfile.ZipFile(big)
+    for name, read in (("ZipFile.read()", lambda item: archive.read(item.rootRelLoc)), ("epubItem.read()", lambda item: item.read())):
+        base = None
+        for threads in (1, 2, 4, 8):
+            with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+                took = timeit(lambda: list(pool.map(read, items)), 2)
+            base = base or took
+            print("%-40s %10.1f MB/s   x%.1f" % ("%s whole book, %d threads" % (name, threads), total / took / 1e6, base / took))
+    archive.close()
+    info.close()
+
+
+def bench_session():
+    """page turn latency reading a book in order (5ms spent on each chapter) with and without a readingSession"""
+    big = makeBook(os.path.join(tempfile.mkdtemp(), "session.epub"), items=30, size=2 * 1024 * 1024)
+    info = epub.epubInfo(big)
+
+    def turns(read):
+        waited = 0.0
+        for item in info.opf.spine:
+            start = time.perf_counter()
+            read(item)
+            waited += time.perf_counter() - start
+            time.sleep(0.005)
+        return waited / len(info.opf.spine)
+
+    base = turns(lambda item: item.read())
+    report("item.read() per page turn", base)
+    with epub.readingSession(info, ahead=2) as session:
+        report("readingSession.read() per page turn", turns(session.read), base)
+        print(session.stats())
+    info.close()
+
+
+def bench_startup():
+    """cold start of a fresh interpreter: import time and time to a first result"""
+    import subprocess
+    script = ("import time; start = time.perf_counter(); import epub; imported = time.perf_counter(); %s; "
+              "print(imported - start, time.perf_counter() - imported)")
+    tasks = (("import epub", "pass"),
+             ("file listing", "epub.epubInfo(%r).namelist()" % SAMPLE),
+             ("readMetadata()", "epub.readMetadata(%r)" % SAMPLE),
+             ("cover", "epub.epubInfo(%r).meta.getMetaData('cover').read()" % SAMPLE))
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    for name, task in tasks:
+        runs = []
+        for run in range(7):
+            output = subprocess.check_output([sys.executable, "-c", script % task], env=env)
+            runs.append([float(value) for value in output.split()])
+        imported, result = sorted(runs, key=sum)[len(runs) // 2]
+        print("%-40s %10.1f ms import %10.1f ms to result" % (name, imported * 1e3, result * 1e3))
+
+
+def bench_fingerprint():
+    """fingerprinting a book from its central directory vs hashing every inflated member"""
+    import hashlib
+    path = makeBook(os.path.join(tempfile.mkdtemp(), "book.epub"), items=500, size=4000)
+
+    def inflated():
+        info = epub.epubInfo(path)
+        digest = hashlib.sha1()
+        for item in info.contents.contents:
+            digest.update(item.read())
+        info.close()
+        return digest.hexdigest()
+
+    base = timeit(inflated, 10)
+    report("sha1 of every inflated member", base)
+    report("fingerprint()", timeit(lambda: epub.fingerprint(path), 10), base)
+
+
+def bench_export():
+    """20000 scan records: one json.dump of the whole list vs exportRecords() batches, time and peak memory"""
+    import json
+    import tracemalloc
+    record = epub._scanBook(SAMPLE, summary=True)
+
+    def records():
+        for i in range(20000):
+            yield dict(record, path="%s.%d" % (SAMPLE, i))
+
+    def dumpAll():
+        with open(os.devnull, "w") as out:
+            json.dump(list(records()), out)
+
+    def export(format):
+        with open(os.devnull, "w", newline="") as out:
+            epub.exportRecords(records(), out, format)
+
+    for name, func in (("json.dump(list)", dumpAll), ("exportRecords() jsonl", lambda: export("jsonl")),
+                       ("exportRecords() csv", lambda: export("csv"))):
+        tracemalloc.start()
+        start = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print("%-40s %10.1f ms %10.1f MiB peak" % (name, seconds * 1e3, peak / 1048576.0))
+
+
+BENCHMARKS = {
+    "export": bench_export,
+    "fingerprint": bench_fingerprint,
+    "startup": bench_startup,
+    "session": bench_session,
+    "threads": bench_threads,
+    "textindex": bench_textindex,
+    "text": bench_text,
+    "toc": bench_toc,
+    "save": bench_save,
+    "readcache": bench_readcache,
+    "memory": bench_memory,
+    "meta": bench_meta,
+    "cache": bench_cache,
+}
+
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        print("== %s" % name)
+        BENCHMARKS[name]()
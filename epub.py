@@ -1,14 +1,33 @@
 # -*- coding: utf-8 -*-
 
 import zipfile
+import io
+import copy
+import os
 import os.path
-import mimetypes
+import posixpath
+import urllib.parse
+import sys
+import time
+import threading
+import collections
 import re
-import math
-import xml.dom.minidom
-import tempfile
-import shutil
+import codecs
+import xml.parsers.expat
+import mmap
+import struct
+import zlib
 import warnings
+import weakref
+import functools
+import itertools
+
+# json, sqlite3, hashlib, tempfile, shutil, html, concurrent.futures, asyncio and xml.dom.minidom are
+# imported where they are used, so opening a book doesn't pay for the caches, scanners and writers
+
+# files on disk at least this large are read through memory maps
+MAP_THRESHOLD = 1024 * 1024
+
 
 class badEpubFile(Exception):
     """Main Exception"""
@@ -26,19 +45,28 @@ class epubError(badEpubFile):
 
 class epubItem(object):
     """central location for opf/ncx data"""
+    __slots__ = ("archive", "_absLoc", "_rootRelLoc", "_opfid", "_opfRelLoc", "compressiontype", "compressed_size",
+                 "file_size", "lastmodified", "mimetype", "ncx", "opf", "spine", "ignore", "linear", "refs", "_contents", "pending")
+
     def __init__(self):
 
+        # epubContents indexing this item (kept up to date when the paths or id below change)
+        self._contents = None
+
         # archive zipfile object
         self.archive = None
 
         # abspath to extracted content (if set ~= you are working with an extracted folder not a zipfile)
-        self.absLoc = None
+        self._absLoc = None
+
+        # path relative to the root of the (imaginary)? zipfile
+        self._rootRelLoc = None
 
         # node id as defined in the OPF
-        self.opfid = None
+        self._opfid = None
 
         # OPF relative path
-        self.opfRelLoc = None
+        self._opfRelLoc = None
 
         # zipInfo data
         self.compressiontype = zipfile.ZIP_DEFLATED
@@ -58,9 +86,6 @@ class epubItem(object):
         # is present in the spine (i.e. is file that will be read by the reader)
         self.spine = False
 
-        # opf dom mainfest node
-        self.opfEl = None
-
         # is a file to ignore when extracting/compressing
         self.ignore = False
 
@@ -70,11 +95,45 @@ class epubItem(object):
         # guide references as defined in the OPF
         self.refs = []
 
+        # replacement content set by write() and not saved yet
+        self.pending = None
+
+    def _indexed(slot, index):
+        """attribute stored in slot that keeps the index of the owning epubContents current"""
+        def get(self):
+            return getattr(self, slot)
+
+        def set(self, value):
+            contents = self._contents
+            if contents is not None:
+                contents._unindex(self, index, getattr(self, slot))
+                setattr(self, slot, value)
+                contents._index(self, index, value)
+            else:
+                setattr(self, slot, value)
+        return property(get, set)
+
+    absLoc = _indexed("_absLoc", "absRelDir")
+    rootRelLoc = _indexed("_rootRelLoc", "rootRelDir")
+    opfid = _indexed("_opfid", "opfIdDir")
+    opfRelLoc = _indexed("_opfRelLoc", "opfRelDir")
+    del _indexed
+
+    @property
+    def opfEl(self):
+        """opf manifest node attributes (rebuilt from the item, no parser data is kept)"""
+        if not self.opf:
+            return None
+        attrs = {"href": self.opfRelLoc, "media-type": self.mimetype}
+        if self.opfid:
+            attrs["id"] = self.opfid
+        return attrs
+
     def open(self, openFor="r"):
-        """Open item for reading/writing"""
+        """Open item for reading/writing (always binary)"""
         if self.absLoc:
             try:
-                return open(self.absLoc, openFor)
+                return open(self.absLoc, openFor if "b" in openFor else openFor + "b")
             except:
                 raise epubError("Unable to open '%s' for reading" % self.absLoc)
                 pass
@@ -87,19 +146,227 @@ class epubItem(object):
         else:
             return None
 
+    def _rawView(self):
+        """(zipinfo, memoryview of the member data) of a stored or deflated archive member, None if it has to go
+        through zipfile (Internal only)
+
+        reads through the view need no file position or lock, so any number of threads can read at once
+        """
+        if self.absLoc or not self.archive or self._contents is None or self._contents.source is None:
+            return None
+        try:
+            info = self.archive.getinfo(self.rootRelLoc)
+        except KeyError:
+            raise epubError("Unable to open '%s' for reading" % self.rootRelLoc)
+        if info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED) or info.flag_bits & 0x1:
+            return None
+        return info, self._contents.source.raw(info)
+
+    def _inflate(self, info, raw, size):
+        """yield the inflated data of a deflated member in chunks of at most size bytes, checking its CRC (Internal only)"""
+        inflater = zlib.decompressobj(-15)
+        crc = 0
+        try:
+            for start in range(0, len(raw), size):
+                data = raw[start:start + size]
+                while data:
+                    chunk = inflater.decompress(data, size)
+                    data = inflater.unconsumed_tail
+                    if chunk:
+                        crc = zlib.crc32(chunk, crc)
+                        yield chunk
+            chunk = inflater.flush()
+        except zlib.error as e:
+            raise epubError("Unable to read '%s': %s" % (self.rootRelLoc, e))
+        if chunk:
+            crc = zlib.crc32(chunk, crc)
+            yield chunk
+        if crc != info.CRC:
+            raise epubError("Bad CRC-32 for '%s'" % self.rootRelLoc)
+
+    def _checkCrc(self, crc):
+        if crc != self.archive.getinfo(self.rootRelLoc).CRC:
+            raise epubError("Bad CRC-32 for '%s'" % self.rootRelLoc)
+
+    def _name(self):
+        return self.absLoc or self.rootRelLoc
+
+    def _cacheKey(self):
+        """itemCache key, names are only unique within a book and a cache can be shared by several (Internal only)"""
+        return (self._contents.cacheId if self._contents is not None else None, self._name())
+
     def read(self):
-        """Open Item for reading only"""
+        """Open Item for reading only (through the readCache of the book if it has one)"""
+        if self.pending is not None:
+            return self.pending
+        cache = self._contents.readCache if self._contents is not None else None
+        if cache is None:
+            return self._read()
+        key = self._cacheKey()
+        data = cache.get(key)
+        if data is None:
+            data = self._read()
+            cache.put(key, data)
+        return data
+
+    def _mapped(self):
+        """read only memory map of a large file on disk, None for archive members and small files (Internal only)"""
+        if not self.absLoc or self.file_size < MAP_THRESHOLD:
+            return None
+        try:
+            with open(self.absLoc, "rb") as f:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            raise epubError("Unable to open '%s' for reading: %s" % (self.absLoc, e))
+
+    def _read(self):
+        mapped = self._mapped()
+        if mapped is not None:
+            try:
+                return mapped[:]
+            finally:
+                mapped.close()
+        raw = self._rawView()
+        if raw is not None:
+            info, data = raw
+            if info.compress_type == zipfile.ZIP_DEFLATED:
+                try:
+                    # one call, zlib releases the GIL while inflating
+                    data = zlib.decompress(data, -15, info.file_size or 1)
+                except zlib.error as e:
+                    raise epubError("Unable to read '%s': %s" % (self.rootRelLoc, e))
+            if zlib.crc32(data) != info.CRC or len(data) != info.file_size:
+                raise epubError("Bad CRC-32 for '%s'" % self.rootRelLoc)
+            return bytes(data)
+        f = self.open()
+        if f is None:
+            raise epubError("'%s' is neither in an archive nor on disk" % self._name())
         try:
-            f = self.open()
-            c = f.read()
+            return f.read()
+        except Exception as e:
+            raise epubError("Unable to read '%s': %s" % (self._name(), e))
+        finally:
             f.close()
-            return c
-        except:
-            return None
 
-    def write(self):
-        """write file to epubFile"""
-        pass
+    def iterChunks(self, size=65536):
+        """yield the content of the item in chunks of at most size bytes
+
+        uncompressed archive members are served as memoryviews of a memory map of the archive (no copy)
+        """
+        if self.pending is not None:
+            pending = memoryview(self.pending)
+            for start in range(0, len(pending), size):
+                yield pending[start:start + size]
+            return
+        mapped = self._mapped()
+        if mapped is not None:
+            view = memoryview(mapped)
+            try:
+                for start in range(0, len(view), size):
+                    yield view[start:start + size]
+            finally:
+                view.release()
+                try:
+                    mapped.close()
+                except BufferError:
+                    # a chunk is still held, the map goes with it
+                    pass
+            return
+        raw = self._rawView()
+        if raw is not None:
+            info, stored = raw
+            if info.compress_type == zipfile.ZIP_DEFLATED:
+                for chunk in self._inflate(info, stored, size):
+                    yield chunk
+                return
+            crc = 0
+            for start in range(0, len(stored), size):
+                chunk = stored[start:start + size]
+                crc = zlib.crc32(chunk, crc)
+                yield chunk
+            self._checkCrc(crc)
+            return
+        f = self.open()
+        if f is None:
+            raise epubError("'%s' is neither in an archive nor on disk" % self._name())
+        try:
+            while True:
+                try:
+                    chunk = f.read(size)
+                except Exception as e:
+                    raise epubError("Unable to read '%s': %s" % (self._name(), e))
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            f.close()
+
+    def readinto(self, buffer):
+        """read the item into a caller provided buffer, returns the number of bytes read (at most len(buffer))
+
+        the CRC of an archive member is checked when the buffer holds all of it
+        """
+        view = memoryview(buffer).cast("B")
+        if self.pending is not None:
+            # written through write(), there is no CRC to check yet
+            pending = memoryview(self.pending)
+            size = min(len(view), len(pending))
+            view[:size] = pending[:size]
+            return size
+        raw = self._rawView()
+        if raw is not None and raw[0].compress_type == zipfile.ZIP_DEFLATED:
+            total = 0
+            for chunk in self._inflate(raw[0], raw[1], 65536):
+                size = min(len(view) - total, len(chunk))
+                view[total:total + size] = chunk[:size]
+                total += size
+                # a buffer that takes the whole member runs the inflater to its end, where the CRC is checked
+                if total == len(view) and len(view) < raw[0].file_size:
+                    break
+            return total
+        if raw is not None:
+            stored = raw[1]
+            size = min(len(view), len(stored))
+            view[:size] = stored[:size]
+            if size == len(stored):
+                self._checkCrc(zlib.crc32(stored))
+            return size
+        mapped = self._mapped()
+        if mapped is not None:
+            try:
+                size = min(len(view), len(mapped))
+                view[:size] = mapped[:size]
+                return size
+            finally:
+                mapped.close()
+        f = self.open()
+        if f is None:
+            raise epubError("'%s' is neither in an archive nor on disk" % self._name())
+        try:
+            total = 0
+            while total < len(view):
+                count = f.readinto(view[total:])
+                if not count:
+                    break
+                total += count
+            return total
+        except Exception as e:
+            raise epubError("Unable to read '%s': %s" % (self._name(), e))
+        finally:
+            f.close()
+
+    async def aread(self, executor=None):
+        """read() run in an executor (see setAsyncExecutor) so the event loop isn't blocked"""
+        return await _asyncRun(executor, self.read)
+
+    def write(self, data):
+        """replace the content of the item (str is written as utf-8), the archive is only touched by epubInfo.save()"""
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.pending = bytes(data)
+        self.file_size = len(self.pending)
+        if self._contents is not None and self._contents.readCache is not None:
+            self._contents.readCache.discard(self._cacheKey())
 
     def info(self):
         """return all info in an arrary"""
@@ -112,15 +379,268 @@ class epubItem(object):
         pass
 
 
+def _zipAppendRaw(out, zinfo, raw):
+    """append a member to the ZipFile out from its raw compressed bytes, zinfo holds its crc and sizes (Internal only)
+
+    zipfile has no public way of doing this, so this is the one place relying on its internals: ZipFile._lock,
+    start_dir and _didModify and ZipInfo.FileHeader(zip64), as found in CPython 3.6 up to 3.13
+    """
+    zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT
+    with out._lock:
+        out.fp.seek(out.start_dir)
+        zinfo.header_offset = out.fp.tell()
+        out._didModify = True
+        out.filelist.append(zinfo)
+        out.NameToInfo[zinfo.filename] = zinfo
+        out.fp.write(zinfo.FileHeader(zip64))
+        out.fp.write(raw)
+        if zinfo.flag_bits & 0x08:
+            # crc and sizes follow the data, 64 bit sizes when the local header has a zip64 extra
+            out.fp.write(struct.pack("<4sLQQ" if zip64 else "<4sLLL", b"PK\x07\x08", zinfo.CRC, zinfo.compress_size, zinfo.file_size))
+        out.start_dir = out.fp.tell()
+
+
+def _pathKey(path):
+    """lookup key for a root or opf relative path: fragment dropped, percent-decoded and normalized"""
+    path = str(path)
+    if "#" in path:
+        path = path.split("#", 1)[0]
+    if "%" in path:
+        path = urllib.parse.unquote(path)
+    if "/." in path or path.startswith(".") or "//" in path:
+        path = posixpath.normpath(path)
+    return path.lstrip("/")
+
+
+class itemCache(object):
+    """bounded LRU cache of decompressed item contents
+
+    pinned entries are never evicted (they still count against maxBytes)
+    """
+    def __init__(self, maxBytes=16 * 1024 * 1024):
+        self.maxBytes = maxBytes
+
+        # key -> bytes, least recently used first
+        self.entries = collections.OrderedDict()
+        self.pinned = set()
+        self.size = 0
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            data = self.entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.maxBytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = data
+            self.size += len(data)
+            self._evict()
+
+    def _evict(self):
+        if self.size <= self.maxBytes:
+            return
+        for key in list(self.entries):
+            if self.size <= self.maxBytes:
+                break
+            if key in self.pinned:
+                continue
+            self.size -= len(self.entries.pop(key))
+            self.evictions += 1
+
+    def pin(self, item):
+        """load an item (i.e. a stylesheet or font used by every chapter) and keep it cached"""
+        key = item._cacheKey()
+        with self.lock:
+            self.pinned.add(key)
+        if key not in self.entries:
+            data = item._read()
+            with self.lock:
+                self.entries[key] = data
+                self.size += len(data)
+                self._evict()
+
+    def discard(self, key):
+        """drop an entry (i.e. when the item was rewritten)"""
+        with self.lock:
+            data = self.entries.pop(key, None)
+            if data is not None:
+                self.size -= len(data)
+            self.pinned.discard(key)
+
+    def unpin(self, item):
+        with self.lock:
+            self.pinned.discard(item._cacheKey())
+            self._evict()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.pinned.clear()
+            self.size = 0
+
+    def stats(self):
+        """hit/miss/eviction counters and current size"""
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": len(self.entries), "pinned": len(self.pinned), "bytes": self.size}
+
+
+class _bufferFile(io.RawIOBase):
+    """read only seekable file over a memoryview, reads copy only what they return (Internal only)"""
+    def __init__(self, view):
+        io.RawIOBase.__init__(self)
+        self.view = view
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        if offset < 0:
+            # what a file on disk does (zipfile expects an OSError)
+            raise OSError(22, "Invalid argument")
+        self.position = offset
+        return offset
+
+    def read(self, size=-1):
+        start = min(self.position, len(self.view))
+        end = len(self.view) if size is None or size < 0 else min(start + size, len(self.view))
+        self.position = end
+        return self.view[start:end].tobytes()
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class _zipSource(object):
+    """position independent access to the raw member data of a zip archive through a memory map (Internal only)
+
+    the archive is either a file (mapped through the descriptor the zipfile holds, on first use) or a buffer given
+    as view. archives read from file objects that can't be mapped have no view, their members are read through the archive under its lock
+    """
+    def __init__(self, archive, view=None):
+        # zipfile object
+        self.archive = archive
+
+        # read only memory map of the archive file and a view over it, made on first use
+        self.map = None
+        self.view = view
+
+        # member name -> offset of its data (past the local file header)
+        self.offsets = {}
+
+        # guards the creation of the map, reads need no lock
+        self.lock = threading.Lock()
+
+    def _getView(self):
+        view = self.view
+        if view is None:
+            with self.lock:
+                if self.view is None:
+                    try:
+                        # the descriptor zipfile holds, not the path: the file there may have been replaced since
+                        self.map = mmap.mmap(self.archive.fp.fileno(), 0, access=mmap.ACCESS_READ)
+                    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+                        # not a regular file (a pipe, a socket, an in memory stream ...), read through the archive
+                        self.view = False
+                    else:
+                        self.view = memoryview(self.map)
+                view = self.view
+        return view
+
+    def _readRaw(self, info):
+        """data of a member read through the archive file object (Internal only)"""
+        archive = self.archive
+        with archive._lock:
+            archive.fp.seek(info.header_offset)
+            header = archive.fp.read(30)
+            if len(header) < 30 or header[:4] != b"PK\x03\x04":
+                raise epubError("Bad local file header for '%s'" % info.filename)
+            nameLength, extraLength = struct.unpack("<2H", header[26:30])
+            archive.fp.seek(info.header_offset + 30 + nameLength + extraLength)
+            return memoryview(archive.fp.read(info.compress_size))
+
+    def raw(self, info):
+        """memoryview of the stored (possibly compressed) data of a member"""
+        view = self._getView()
+        if view is False:
+            return self._readRaw(info)
+        offset = self.offsets.get(info.filename)
+        if offset is None:
+            header = view[info.header_offset:info.header_offset + 30]
+            if len(header) < 30 or header[:4] != b"PK\x03\x04":
+                raise epubError("Bad local file header for '%s'" % info.filename)
+            nameLength, extraLength = struct.unpack("<2H", header[26:30])
+            offset = info.header_offset + 30 + nameLength + extraLength
+            self.offsets[info.filename] = offset
+        return view[offset:offset + info.compress_size]
+
+    def close(self):
+        if self.view:
+            try:
+                self.view.release()
+                if self.map is not None:
+                    self.map.close()
+            except BufferError:
+                # someone still holds a chunk, the map goes when they let go of it
+                pass
+        self.map = None
+        self.view = None
+
+
+_contentsIds = itertools.count()
+
+
 class epubContents(object):
     """epubItems container
 
-    useful for search and path to epubItem fuctions
+    useful for search and path to epubItem fuctions, the directories are kept current by the items themselves
     """
+
+    # key functions of each directory
+    _keys = {"rootRelDir": _pathKey, "opfRelDir": _pathKey, "absRelDir": lambda path: os.path.normpath(str(path)), "opfIdDir": str}
+
     def __init__(self, contents):
         # contentsArr inherited from epubInfo
         self.contents = contents
 
+        # _zipSource of the archive the items live in
+        self.source = None
+
+        # optional itemCache used by epubItem.read()
+        self.readCache = None
+
+        # tells these items apart from those of other books in a shared itemCache (never reused)
+        self.cacheId = next(_contentsIds)
+
         # Directory of file root relative paths to items
         self.rootRelDir = {}
 
@@ -133,38 +653,67 @@ class epubContents(object):
         # Directory of OPF manifest ID's to items
         self.opfIdDir = {}
 
+    def _index(self, item, index, value):
+        if value:
+            getattr(self, index)[self._keys[index](value)] = item
+
+    def _unindex(self, item, index, value):
+        if value:
+            directory = getattr(self, index)
+            key = self._keys[index](value)
+            if directory.get(key) is item:
+                del directory[key]
+
+    def _indexItem(self, item):
+        item._contents = self
+        self._index(item, "rootRelDir", item._rootRelLoc)
+        self._index(item, "opfRelDir", item._opfRelLoc)
+        self._index(item, "absRelDir", item._absLoc)
+        self._index(item, "opfIdDir", item._opfid)
+
+    def add(self, item):
+        """add an epubItem and index it"""
+        self.contents.append(item)
+        self._indexItem(item)
+
+    def remove(self, item):
+        """remove an epubItem and its keys"""
+        self.contents.remove(item)
+        self._unindex(item, "rootRelDir", item._rootRelLoc)
+        self._unindex(item, "opfRelDir", item._opfRelLoc)
+        self._unindex(item, "absRelDir", item._absLoc)
+        self._unindex(item, "opfIdDir", item._opfid)
+        item._contents = None
+
     def update(self, contents=None):
-        """Updates epubContents from a contentsArr"""
+        """Rebuilds epubContents from a contentsArr (only needed if the array was changed behind our back)"""
         if contents:
             self.contents = contents
+        self.rootRelDir = {}
+        self.opfRelDir = {}
+        self.absRelDir = {}
+        self.opfIdDir = {}
         for item in self.contents:
-            if item.rootRelLoc:
-                self.rootRelDir[str(item.rootRelLoc)] = item
-            if item.opfRelLoc:
-                self.opfRelDir[str(item.opfRelLoc)] = item
-            if item.absLoc:
-                self.absRelDir[str(item.absLoc)] = item
-            if item.opfid:
-                self.opfIdDir[str(item.opfid)] = item
+            self._indexItem(item)
 
     def getItemFromRoot(self, path):
         "get epubItem object from file root relative path"
         try:
-            return self.rootRelDir[str(path)]
+            return self.rootRelDir[_pathKey(path)]
         except:
             raise epubError("No epub item associated with root path '%s'" % str(path))
 
     def getItemFromOpf(self, path):
         "get epubItem object from opf file relative path"
         try:
-            return self.opfRelDir[str(path)]
+            return self.opfRelDir[_pathKey(path)]
         except:
             raise epubError("No epub item associated with opf path '%s'" % str(path))
 
     def getItemFromAbs(self, path):
         "get epubItem object from file absolute relative path"
         try:
-            return self.absRelDir[str(path)]
+            return self.absRelDir[os.path.normpath(str(path))]
         except:
             raise epubError("No epub item associated with absolute path '%s'" % str(path))
 
@@ -178,165 +727,260 @@ class epubContents(object):
 
 class META(object):
     """docstring for META"""
-    def __init__(self, opfDom, ncxDom, contents):
-
-        # constants
-        self.UNIQUE = 8
-        self.REQUIRED = 16
-        self.TEXTVALUE = 32
-        self.ATTRVALUE = 64
-        self.IDREF = 128
-        self.OPFPATHREF = 256
-        self.ROOTPATHREF = 512
-        self.ITEMVALUE = 1024
-
-        self.opfDom = opfDom
+
+    # constants (plain bit flags)
+    UNIQUE = 8
+    REQUIRED = 16
+    TEXTVALUE = 32
+    ATTRVALUE = 64
+    IDREF = 128
+    OPFPATHREF = 256
+    ROOTPATHREF = 512
+    ITEMVALUE = 1024
+
+    # default templates, name -> node name, attribute (name, value, flags) predicates, id and flags
+    TEMPLATES = {
+                "title": {"name": "dc:title", "attr": None, "id": None, "flags": REQUIRED | TEXTVALUE},
+                "description": {"name": "dc:description", "attr": None, "id": None, "flags": TEXTVALUE},
+                "author": {"name": "dc:creator", "attr": [("opf:role", "aut", None)], "id": None, "flags": REQUIRED | TEXTVALUE},
+                "identifer": {"name": "dc:identifier", "attr": [("opf:scheme", None, ATTRVALUE)], "id": None, "flags": REQUIRED | TEXTVALUE},
+                "language": {"name": "dc:language", "attr": None, "id": None, "flags": REQUIRED | TEXTVALUE},
+                "datepub": {"name": "dc:date", "attr": [("opf:event", "publication", ATTRVALUE)], "id": None, "flags": TEXTVALUE},
+                "datemod": {"name": "dc:date", "attr": [("opf:event", "modification", ATTRVALUE)], "id": None, "flags": TEXTVALUE},
+                "date": {"name": "dc:date", "attr": [("opf:event", None, ATTRVALUE)], "id": None, "flags": TEXTVALUE},
+                "cover": {"name": "meta", "attr": [("name", "cover", None), ("content", None, ITEMVALUE | IDREF)], "id": None, "flags": REQUIRED},
+
+                }
+
+    # compiled index of TEMPLATES, shared by every META that hasn't added templates of its own
+    _defaultIndex = None
+
+    def __init__(self, metadata, ncxDom, contents, values=None):
+        # opfNodes of the OPF metadata block in document order
+        self.metadata = metadata
         self.ncxDom = ncxDom
         self.contents = contents
-        self.metaDom = None
+
+        # already extracted template values (i.e. from a metaCache), used instead of the nodes
+        self.values = values or {}
 
         self.data = {}
-        self.templates = {
-                    "title": {"name": "dc:title", "attr": None, "id": None, "flags": self.REQUIRED | self.TEXTVALUE},
-                    "description": {"name": "dc:description", "attr": None, "id": None, "flags": self.TEXTVALUE},
-                    "author": {"name": "dc:creator", "attr": [("opf:role", "aut", None)], "id": None, "flags": self.REQUIRED | self.TEXTVALUE},
-                    "identifer": {"name": "dc:identifier", "attr": [("opf:scheme", None, self.ATTRVALUE)], "id": None, "flags": self.REQUIRED | self.TEXTVALUE},
-                    "language": {"name": "dc:language", "attr": None, "id": None, "flags": self.REQUIRED | self.TEXTVALUE},
-                    "datepub": {"name": "dc:date", "attr": [("opf:event", "publication", self.ATTRVALUE)], "id": None, "flags": self.TEXTVALUE},
-                    "datemod": {"name": "dc:date", "attr": [("opf:event", "modification", self.ATTRVALUE)], "id": None, "flags": self.TEXTVALUE},
-                    "date": {"name": "dc:date", "attr": [("opf:event", None, self.ATTRVALUE)], "id": None, "flags": self.TEXTVALUE},
-                    "cover": {"name": "meta", "attr": [("name", "cover", None), ("content", None, self.ITEMVALUE | self.IDREF)], "id": None, "flags": self.REQUIRED},
-
-                    }
-        self.getMetaDom()
+        self.templates = dict(self.TEMPLATES)
+        if META._defaultIndex is None:
+            META._defaultIndex = self._compileTemplates()
+        self.index = META._defaultIndex
         self.getData()
 
-    def getMetaDom(self):
-        # check for metadata in OPF
-        if len(self.opfDom.getElementsByTagName("metadata")) > 0:
-            self.metaDom = self.opfDom.getElementsByTagName("metadata")[0]
-        else:
-            return False
-
     def _testFlag(self, flags, test):
-        constants = [self.UNIQUE, self.REQUIRED, self.TEXTVALUE, self.ATTRVALUE, self.IDREF, self.OPFPATHREF, self.ROOTPATHREF, self.ITEMVALUE]
-        constants.sort(reverse=True)
-        tester = 0
-        flags = flags if flags!=None else 0
-        test_against = test
-        for constant in constants:
-            if flags >= constant:
-                if test_against >= constant:
-                    test_against = test_against - constant
-                    tester = tester + constant
-                flags = flags - constant
-        if tester == test:
-            return True
-        return False
-
-    def _loopNodes(self, parent, cnodes=[]):
-        for node in parent.childNodes:
-            if not node.nodeType == node.TEXT_NODE:
-                cnodes.append(node)
-                if len(node.childNodes):
-                    cnodes = self._loopNodes(node, cnodes)
-        return cnodes
+        return (flags or 0) & test == test
+
+    def _compileTemplates(self):
+        """index templates by node name, each entry is (template name, attribute predicates)"""
+        index = {}
+        for temp_name, template in self.templates.items():
+            predicates = [(attr[0], attr[1]) for attr in template["attr"] or []]
+            if template["id"]:
+                predicates.append(("id", template["id"]))
+            index.setdefault(template["name"], []).append((temp_name, tuple(predicates)))
+        return index
 
     def addDataTemplate(self, name, nodeName, attr=None, nid=None, flags=0):
         if not name in self.templates:
-            self.templates[name] = {"name": nodeName, "attr": attr, "id": nid, "flags": []}
+            self.templates[name] = {"name": nodeName, "attr": attr, "id": nid, "flags": flags}
+            self.index = self._compileTemplates()
+            self.getData()
         else:
             print("Already a template with the name '%s' (this name must be unique to the template array and should not be confused with node name)" % name)
 
-    def getMetaData(self, value):
+    def _resolveRef(self, value, flags):
+        """resolve an item reference (left as the raw reference when there are no contents to link against)"""
+        if self.contents is None:
+            return value
+        if flags & self.ITEMVALUE and flags & self.IDREF:
+            return self.contents.getItemFromOpfId(value)
+        elif flags & self.ITEMVALUE:
+            return self.contents.getItemFromOpf(value)
+        return self.contents.getItemFromOpfId(value).opfRelLoc
+
+    def getMetaData(self, *values):
+        """get metadata values by template name
+
+        a single name returns its value, several names (or none for every template) return a dict of name -> value
+        """
+        if len(values) == 1:
+            return self._getValue(values[0])
+        return dict((value, self._getValue(value)) for value in values or self.templates)
+
+    def _getValue(self, value):
+        if value in self.values:
+            return self.values[value]
         if not value in self.templates:
-            warnings.warn("No Template", "No matching template can be found for %s" % value)
+            warnings.warn("No matching template can be found for %s" % value)
             return None
         template = self.templates[value]
+        flags = template["flags"] or 0
         output = []
         if not value in self.data:
-            #warnings.warn("Meta Data Not Found", "No Metadata element could be found matching template for %s" % value)
+            #warnings.warn("No Metadata element could be found matching template for %s" % value)
             return None
         for element in self.data[value]:
             elData = []
-            if self._testFlag(template["flags"], self.TEXTVALUE):
-                elData.append(element.firstChild.nodeValue)
+            if flags & self.TEXTVALUE:
+                elData.append(element.text)
 
-            elif self._testFlag(template["flags"], self.ITEMVALUE | self.IDREF):
-                elData.append(self.contents.getItemFromOpfId(element.firstChild.nodeValue))
-            elif self._testFlag(template["flags"], self.ITEMVALUE):
-                elData.append(self.contents.getItemFromOpf(element.firstChild.nodeValue))
-            elif self._testFlag(template["flags"], self.IDREF):
-                elData.append(self.contents.getItemFromOpfId(element.firstChild.nodeValue).opfRelLoc)
+            elif flags & (self.ITEMVALUE | self.IDREF):
+                elData.append(self._resolveRef(element.text, flags))
 
             if template["attr"]:
-                for attr in template["attr"]:
-                    attr_name, attr_value, attr_flags = attr
+                for attr_name, attr_value, attr_flags in template["attr"]:
+                    attr_flags = attr_flags or 0
                     elvalue = element.getAttribute(attr_name)
-                    if self._testFlag(attr_flags, self.ATTRVALUE):
+                    if attr_flags & self.ATTRVALUE:
                         elData.append(elvalue)
-                    elif self._testFlag(attr_flags, self.ITEMVALUE | self.IDREF):
-                        elData.append(self.contents.getItemFromOpfId(elvalue))
-                    elif self._testFlag(attr_flags, self.ITEMVALUE):
-                        elData.append(self.contents.getItemFromOpf(elvalue))
-                    elif self._testFlag(attr_flags, self.IDREF):
-                        elData.append(self.contents.getItemFromOpfId(elvalue).opfRelLoc)
+                    elif attr_flags & (self.ITEMVALUE | self.IDREF):
+                        elData.append(self._resolveRef(elvalue, attr_flags))
             if len(elData) > 1:
                 output.append(elData)
-            else:
+            elif elData:
                 output.append(elData[0])
         if len(output) > 1:
             return output
-        else:
+        elif output:
             return output[0]
+        return None
 
     def getData(self):
+        """match every metadata node against the compiled templates in a single pass"""
         self.data = {}
-        for node in self._loopNodes(self.metaDom):
-            for temp_name, temp_pattern in iter(self.templates.items()):
-                if self._testNodeAgainstTemplate(node, temp_pattern):
-                    if not temp_name in self.data:
-                        self.data[temp_name] = []
-                    self.data[temp_name].append(node)
-
-    def _testNodeAgainstTemplate(self, node, template):
-        if node.nodeName == template["name"]:
-            if template["attr"]:
-                if not node.hasAttributes():
-                    return False
-                for attr in template["attr"]:
-                    attr_name = attr[0]
-                    attr_value = attr[1]
-                    if not node.hasAttribute(attr_name):
-                        return False
-                    if attr_value:
-                        if not node.getAttribute(attr_name) == attr_value:
-                            return False
-            if template["id"]:
-                if node.hasAttribute("id"):
-                    if not node.getAttribute(attr_name) == template["id"]:
-                        return False
+        index = self.index
+        for node in self.metadata:
+            candidates = index.get(node.nodeName)
+            if not candidates:
+                continue
+            attributes = node.attributes
+            for temp_name, predicates in candidates:
+                for attr_name, attr_value in predicates:
+                    if not attr_name in attributes or (attr_value and attributes[attr_name] != attr_value):
+                        break
                 else:
-                    return False
-            return True
+                    self.data.setdefault(temp_name, []).append(node)
+
+
+class opfNode(object):
+    """element of the OPF metadata block (kept instead of a dom)"""
+    __slots__ = ("nodeName", "attributes", "text")
+
+    def __init__(self, nodeName, attributes):
+        self.nodeName = nodeName
+        self.attributes = attributes
+        self.text = ""
+
+    def hasAttributes(self):
+        return bool(self.attributes)
+
+    def hasAttribute(self, name):
+        return name in self.attributes
+
+    def getAttribute(self, name):
+        return self.attributes.get(name, "")
+
+
+class _opfStop(Exception):
+    """raised by _opfParser to stop reading once it has what it needs"""
+    pass
+
+
+class _opfParser(object):
+    """single pass event driven OPF reader (Internal only)
+
+    collects the metadata nodes and the attributes of the manifest, spine and guide entries without building a dom
+    """
+    def __init__(self, metaOnly=False):
+        # stop once the metadata block has been read
+        self.metaOnly = metaOnly
+
+        # opfNodes of the metadata block in document order
+        self.metadata = []
+
+        # attribute dicts of manifest "item", spine "itemref" and guide "reference" nodes
+        self.manifest = []
+        self.spine = []
+        self.guide = []
+
+        # attributes of the spine node itself
+        self.spineAttrs = {}
+
+        self._stack = []
+        self._text = []
+
+    def parse(self, stream):
+        parser = xml.parsers.expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = self._start
+        parser.EndElementHandler = self._end
+        parser.CharacterDataHandler = self._data
+        try:
+            parser.ParseFile(stream)
+        except _opfStop:
+            pass
+        return self
+
+    def _start(self, name, attrs):
+        stack = self._stack
+        section = stack[1] if len(stack) > 1 else None
+        if section == "metadata":
+            node = opfNode(name, attrs)
+            self.metadata.append(node)
+            self._text.append(node)
+        elif section == "manifest":
+            if name == "item":
+                self.manifest.append(attrs)
+        elif section == "spine":
+            if name == "itemref":
+                self.spine.append(attrs)
+        elif section == "guide":
+            if name == "reference":
+                self.guide.append(attrs)
+        elif len(stack) == 1 and name == "spine":
+            self.spineAttrs = attrs
+        stack.append(name)
+
+    def _end(self, name):
+        stack = self._stack
+        stack.pop()
+        if len(stack) > 1 and stack[1] == "metadata":
+            self._text.pop()
+        elif len(stack) == 1 and name == "metadata" and self.metaOnly:
+            raise _opfStop()
+
+    def _data(self, data):
+        if self._text:
+            self._text[-1].text += data
 
-        else:
-            return False
 
 class OPF():
     """OPF handling class"""
-    def __init__(self, opfLocation, contents):
+    def __init__(self, opfLocation, contents, stats=None):
         # location of OPF file
         self.location = opfLocation
 
         # location of NCX file
         self.ncxLocation = None
 
+        # location of the EPUB3 navigation document (manifest item with the "nav" property)
+        self.navLocation = None
+
         # contentsArr inherited from epubInfo
         self.contents = contents
 
-        # opf xml dom
-        self.opfdom = None
+        # opfNodes of the metadata block
+        self.metadata = []
+
+        # raw OPF entries as read by _opfParser
+        self.parsed = None
+
+        # openStats the phases are recorded in (optional)
+        self.stats = stats
 
         self.clearopf()
         self.update()
@@ -348,276 +992,3924 @@ class OPF():
         self.guide = []
 
     def read(self):
-        """reads opf file as xml dom"""
+        """reads opf file in a single pass"""
         # open the file
         try:
             rootItem = self.contents.getItemFromRoot(self.location)
-            root = rootItem.open()
+            root = io.BytesIO(rootItem.pending) if rootItem.pending is not None else rootItem.open()
         except:
             raise epubError("There is no item named '%s' in this epubfile" % self.location)
 
         # parse the file as xml
         try:
-            self.opfdom = xml.dom.minidom.parse(root)
-            self.opfdom.normalize()
+            self.parsed = _opfParser().parse(root)
         except:
             raise epubError("'%s' is invalid XML" % self.location)
+        finally:
+            root.close()
+        self.metadata = self.parsed.metadata
 
     def update(self):
-        """populate sections from OPF dom"""
-        self.read()
-        self._getManifest()
-        self._getSpine()
-        self._getGuide()
+        """populate sections from OPF"""
+        if self.stats is None:
+            self.read()
+            self._getManifest()
+            self._getSpine()
+            self._getGuide()
+        else:
+            start = time.perf_counter()
+            self.read()
+            size = self.contents.getItemFromRoot(self.location).file_size
+            parsed = len(self.parsed.manifest) + len(self.parsed.spine) + len(self.parsed.guide)
+            start = self.stats.record("opf", start, size, parsed)
+            self._getManifest()
+            start = self.stats.record("manifest", start, 0, len(self.manifest))
+            self._getSpine()
+            start = self.stats.record("spine", start, 0, len(self.spine))
+            self._getGuide()
+            self.stats.record("guide", start, 0, len(self.guide))
+
+        # everything has been linked to epubItems, the raw entries aren't needed anymore
+        self.parsed = None
 
     def _getManifest(self):
         """matches nodes in OPF manifest to epubItems in epubContents"""
 
         # check manifest exists
-        if len(self.opfdom.getElementsByTagName("manifest")) > 0:
+        if self.parsed.manifest:
 
-            # manifest only dom
-            protomani = self.opfdom.getElementsByTagName("manifest")[0]
+            # directory of the OPF, manifest hrefs are relative to it
+            opfDir = posixpath.dirname(self.location)
 
-            # loop over child "item" nodes
-            for node in protomani.getElementsByTagName("item"):
+            # loop over "item" nodes
+            for node in self.parsed.manifest:
 
                 # opf relative path as defined in OPF
-                relpath = node.getAttribute('href')
+                relpath = node.get("href", "")
 
                 # root path in (imaginary)? zipfile
-                rootpath = os.path.dirname(self.location) + "/" + relpath
+                rootpath = opfDir + "/" + relpath if opfDir else relpath
 
                 # get epubItem from contents and set relevant data
                 item = self.contents.getItemFromRoot(rootpath)
                 item.opf = True
-                item.opfEl = node
-                item.opfRelLoc = relpath
-                if node.getAttribute("id"):
-                    item.opfid = node.getAttribute("id")
-                if node.getAttribute("media-type"):
-                            item.mimetype = node.getAttribute("media-type")
                 item.opfRelLoc = relpath
+                if node.get("id"):
+                    item.opfid = node["id"]
+                if node.get("media-type"):
+                    item.mimetype = node["media-type"]
+                if "nav" in node.get("properties", "").split():
+                    self.navLocation = item.rootRelLoc
+
+                # spine "toc" attribute takes precedence (see _getSpine)
+                if item.mimetype == "application/x-dtbncx+xml" and not self.ncxLocation:
+                    self.ncxLocation = item.rootRelLoc
 
                 # add our item to the manifest
                 self.manifest.append(item)
 
-            # because we have changed important information in epubItems we need to update epubContents to reflect this
-            self.contents.update()
-
     def _getSpine(self):
         """matches nodes in OPF manifest to epubItems in epubContents"""
 
-        # check spine exists
-        if len(self.opfdom.getElementsByTagName("spine")) > 0:
-            # spine only dom
-            spine = self.opfdom.getElementsByTagName("spine")[0]
+        # find the NCX file location
+        if self.parsed.spineAttrs.get("toc"):
+            item = self.contents.getItemFromOpfId(self.parsed.spineAttrs["toc"])
+            self.ncxLocation = item.rootRelLoc
 
-            # find the NCX file location
-            if spine.getAttribute("toc"):
-                item = self.contents.getItemFromOpfId(spine.getAttribute("toc"))
-                self.ncxLocation = item.rootRelLoc
+        # check spine exists
+        if self.parsed.spine:
 
-            # loop over child "itemref" nodes
-            for node in spine.getElementsByTagName("itemref"):
+            # loop over "itemref" nodes
+            for node in self.parsed.spine:
 
                 # get epubItem from contents and relevant data
-                item = self.contents.getItemFromOpfId(node.getAttribute("idref"))
-                if not node.getAttribute("linear") == "no":
-                    item.linear = True
+                item = self.contents.getItemFromOpfId(node.get("idref", ""))
+                item.linear = node.get("linear") != "no"
                 item.spine = True
 
                 # add our item to the spine
                 self.spine.append(item)
 
-            # because we have changed important information in epubItems we need to update epubContents to reflect this
-            self.contents.update()
-
     def _getGuide(self):
         """matches nodes in OPF manifest to epubItems in epubContents"""
 
         # check guide exists
-        if len(self.opfdom.getElementsByTagName("guide")) > 0:
+        if self.parsed.guide:
 
-            # guide only dom
-            refs = self.opfdom.getElementsByTagName("guide")[0]
-
-            # loop over child "references" nodes
-            for node in refs.getElementsByTagName("reference"):
+            # loop over "reference" nodes
+            for node in self.parsed.guide:
 
                 # get item from OPF relative location
-                item = self.contents.getItemFromOpf(node.getAttribute("href"))
+                item = self.contents.getItemFromOpf(node.get("href", ""))
 
                 # update the item with it's references
-                item.refs.append([node.getAttribute("type"), node.getAttribute("title")])
+                item.refs.append([node.get("type", ""), node.get("title", "")])
 
                 # add the epubItem to the guide
-                self.guide.append([node.getAttribute("type"), node.getAttribute("title"), item])
+                self.guide.append([node.get("type", ""), node.get("title", ""), item])
 
-            # because we have changed important information in epubItems we need to update epubContents to reflect this
-            self.contents.update()
 
+class tocEntry(object):
+    """entry of the table of contents"""
+    __slots__ = ("id", "label", "item", "fragment", "playOrder", "parent", "children", "depth")
 
-class NCX(object):
-    """docstring for NCX"""
-    def __init__(self, ncxLocation, contents):
-        self.path = ncxLocation
-        self.ncxdom = None
+    def __init__(self, id, label, item, fragment, parent):
+        # navPoint id (or the id of the nav list item)
+        self.id = id
 
+        # text shown for the entry
+        self.label = label
 
-class epubInfo(object):
-    """Information about and Epub file
+        # target epubItem (None when it isn't in the book) and fragment id within it
+        self.item = item
+        self.fragment = fragment
 
-    should only really be publicly used for reading data with no intention of writing. if you plan on writing you should be using epubFile() instead
-    """
-    def __init__(self, path, openFor="r"):
-        # epubfile path
-        self.path = os.path.abspath(path)
+        # position in reading order
+        self.playOrder = 0
 
-        # Contents of (imagineary)? epubfile
-        self.contentsArr = []
-        self.contents = epubContents(self.contentsArr)
+        self.parent = parent
+        self.children = []
+        self.depth = parent.depth + 1 if parent is not None else 0
 
-        # container file (becomes container item I think at the moment and this needs to be fixed)
-        self.container = "META-INF/container.xml"
+    def walk(self):
+        """this entry and all of its descendants in document order"""
+        stack = [self]
+        while stack:
+            entry = stack.pop()
+            yield entry
+            stack.extend(reversed(entry.children))
 
-        # zipfile object
-        self.archive = None
 
-        # location of OPF file
-        self.opfLocation = None
+class _tocParser(object):
+    """event driven reader of an NCX navMap or the "toc" nav of an EPUB3 navigation document (Internal only)"""
+    def __init__(self, ncx, location, nav):
+        self.ncx = ncx
+        self.nav = nav
 
-        # loction of extracted temporary files
-        self.tmpLocation = None
+        # targets are relative to the TOC document
+        self.base = posixpath.dirname(location)
 
-        # open for reading/writing
-        self.openFor = openFor
+        # tocEntry being read (None at the top level)
+        self.entry = None
 
-        # update and get opf location from file container
-        self.update()
-        self.opfLocation = self._getOPFLocation()
+        # depth of the enclosing toc nav element and of the elements read inside it (nav documents only)
+        self.inToc = False
+        self.depth = 0
 
-        # OPF Data
-        self.opf = OPF(self.opfLocation, self.contents)
+        # label text collected for the current entry, or None while not inside a label
+        self.text = None
 
-        # NCX Data
-        self.ncx = NCX(self.opf.ncxLocation, self.contents)
+        # depth of the nav element the label is collected for, its nested elements add to the same text
+        self.textDepth = None
 
-        # Meta data
-        self.meta = META(self.opf.opfdom, self.ncx.ncxdom, self.contents)
+    def parse(self, stream):
+        parser = xml.parsers.expat.ParserCreate()
+        parser.buffer_text = True
+        parser.UseForeignDTD(True)
+        parser.SetParamEntityParsing(xml.parsers.expat.XML_PARAM_ENTITY_PARSING_NEVER)
+        parser.StartElementHandler = self._navStart if self.nav else self._ncxStart
+        parser.EndElementHandler = self._navEnd if self.nav else self._ncxEnd
+        parser.CharacterDataHandler = self._data
+        parser.SkippedEntityHandler = self._entity
+        parser.ParseFile(stream)
 
-    def _isArchive(self):
-        """this is somewhat retarded but.... meh! it deffinately made sense at the time"""
-        if self.path and os.path.exists(self.path):
-            return zipfile.is_zipfile(self.path)
+    def _data(self, data):
+        if self.text is not None:
+            self.text.append(data)
 
-    def _readArchive(self):
-        """read contents of archive into contents"""
-        # create zipfile object
-        self.archive = zipfile.ZipFile(self.path, "r")
+    def _entity(self, name, isParameter):
+        # html named entities (&nbsp; ...) in nav documents without a DTD
+        if self.text is not None and not isParameter:
+            import html
+            self.text.append(html.unescape("&%s;" % name))
 
-        # if we want to do some writing then we need to extract to a tmp folder as you can't read and write from a zipfile at the same time
-        if self.openFor == "w":
-            self.tmpLocation = tempfile.mkdtemp()
-            self.archive.extractall(self.tmpLocation)
+    def _open(self, id):
+        entry = tocEntry(id, "", None, None, self.entry)
+        self.ncx._add(entry)
+        self.entry = entry
 
-        # build epubItems from contents of zipfile
-        for member in self.archive.infolist():
-            item = epubItem()
-            item.archive = self.archive
-            if self.openFor == "w":
-                item.absLoc = os.path.normpath(os.path.join(self.tmpLocation, member.filename))
-            item.rootRelLoc = member.filename
-            item.compressiontype = member.compress_type
-            item.lastmodified = member.date_time
-            item.compressed_size = member.compress_size
-            item.file_size = member.file_size
+    def _close(self):
+        self.entry = self.entry.parent
 
-            # add this epubItem to the contents array
-            self.contentsArr.append(item)
+    def _target(self, src):
+        entry = self.entry
+        if entry is None or entry.item is not None or not src:
+            return
+        path, _, fragment = src.partition("#")
+        entry.fragment = urllib.parse.unquote(fragment) or None
+        if ":" in path.split("/", 1)[0]:
+            # external (http: ...)
+            return
+        try:
+            entry.item = self.ncx.contents.getItemFromRoot(posixpath.join(self.base, path)) if path else None
+        except epubError:
+            return
+        if entry.item is not None:
+            entry.item.ncx = True
 
-            # if this item is the container file then cheesecake
-            if item.rootRelLoc == self.container:
-                self.container = item
-        # epubItems have changed so we need to update epubContents for serch etc.
-        self.contents.update(self.contentsArr)
+    def _label(self):
+        if self.text is not None and self.entry is not None and not self.entry.label:
+            self.entry.label = " ".join("".join(self.text).split())
+        self.text = None
 
-    def _readDir(self):
-        """read contents of directory as an extracted epubfile"""
-        pass
+    def _ncxStart(self, name, attrs):
+        if name == "navPoint":
+            self._open(attrs.get("id"))
+            if attrs.get("playOrder", "").isdigit():
+                self.entry.playOrder = int(attrs["playOrder"])
+        elif name == "text" and self.entry is not None:
+            self.text = []
+        elif name == "content":
+            self._target(attrs.get("src"))
 
-    def update(self):
-        """updates objects from source"""
-        if self._isArchive():
-            self._readArchive()
-        elif os.path.isdir(self.path):
-            self._readDir()
-        else:
-            self.archive = None
+    def _ncxEnd(self, name):
+        if name == "navPoint":
+            self._close()
+        elif name == "text":
+            self._label()
 
-    def _getOPFLocation(self):
-        """Retreive OPF location from the container.xml file found in META-INF (Internal only)"""
-        if self._isArchive():
-            try:
-                container = self.archive.open(self.container.rootRelLoc)
-            except:
-                raise epubError("META-INF/container.xml appears to be missing :(")
-        elif self.tmpLocation:
-            try:
-                container = open(self.container.absLoc)
-            except:
-                raise epubError("META-INF/container.xml appears to be missing :(")
+    def _navStart(self, name, attrs):
+        if not self.inToc:
+            if name == "nav" and any(key.endswith("type") and "toc" in value.split() for key, value in attrs.items()):
+                self.inToc = True
+                self.depth = 0
+            return
+        self.depth += 1
+        if name == "li":
+            self._open(attrs.get("id"))
+        elif (name == "a" or name == "span") and self.entry is not None and not self.entry.label:
+            if name == "a":
+                self._target(attrs.get("href"))
+                self.entry.id = self.entry.id or attrs.get("id")
+            if self.text is None:
+                self.text = []
+                self.textDepth = self.depth
 
-        try:
-            dom = xml.dom.minidom.parse(container)
-            dom.normalize()
-        except:
-            raise epubError("META-INF/container.xml is invalid XML")
+    def _navEnd(self, name):
+        if not self.inToc:
+            return
+        if self.depth == 0:
+            # end of the toc nav, anything after it is another nav (page-list, landmarks ...)
+            self.inToc = False
+            return
+        if self.text is not None and self.depth == self.textDepth:
+            self._label()
+            self.textDepth = None
+        self.depth -= 1
+        if name == "li":
+            self._close()
+
+
+class NCX(object):
+    """table of contents of the book, read from the EPUB3 navigation document if there is one, else from the NCX
+
+    parsed on first access, the indexes map navPoint ids and (item, fragment) targets straight to tocEntries
+    """
+    def __init__(self, ncxLocation, contents, navLocation=None, spine=None):
+        self.path = ncxLocation
+        self.navPath = navLocation
+        self.contents = contents
+        self.ncxdom = None
+
+        # spine epubItems, used to place items without an entry of their own (see locate())
+        self.spine = spine or []
+
+        # top level tocEntries, None until parsed
+        self._entries = None
 
+        # id -> tocEntry and (item, fragment) -> first tocEntry pointing there
+        self._byId = {}
+        self._byTarget = {}
+
+        # item -> tocEntry the item belongs to in reading order (built on first locate())
+        self._chapters = None
+
+    def _parse(self):
+        """read the table of contents (Internal only)"""
+        self._entries = []
+        self._byId = {}
+        self._byTarget = {}
+        self._chapters = None
+        if self.navPath:
+            location, nav = self.navPath, True
+        elif self.path:
+            location, nav = self.path, False
+        else:
+            return
         try:
-            rootfile = dom.getElementsByTagName("rootfile")[0]
-        except:
-            raise epubError("META-INF/container.xml is improperly formatted (unable to find rootfile)")
+            stream = self.contents.getItemFromRoot(location).open()
+        except epubError:
+            raise epubError("There is no item named '%s' in this epubfile" % location)
+        try:
+            _tocParser(self, location, nav).parse(stream)
+        except xml.parsers.expat.ExpatError as e:
+            raise epubError("'%s' is invalid XML: %s" % (location, e))
+        finally:
+            stream.close()
 
-        return rootfile.getAttribute("full-path")
+        # nav documents have no playOrder, number every entry in document order
+        if nav or not any(entry.playOrder for entry in self._byId.values()):
+            for order, entry in enumerate(self, 1):
+                entry.playOrder = order
 
-    def findIDreferences(self, *query):
-        if not query:
-            query = [r'(.*?)']
-        for item in self.contents.contents:
-            if item.mimetype.endswith("+xml") or item.mimetype.endswith("xhtml"):
-                content = item.read()
-                for que in query:
-                    qidDec = re.compile(r"id=(\"|\')" + que + r"\1")
-                    qidRef = re.compile(r"([^\s]*)=(\"|\')([^#]*)#" + que + r"\2")
-                    if qidDec.search(content):
-                        print(str(que) + " declarations:")
-                    for match in re.finditer(qidDec, content):
-                        print("\t" + item.opfRelLoc)
-                    if qidRef.search(content):
-                        print(str(que) + " Referneces:")
-                    for match in re.finditer(qidRef, content):
-                        print("\t" + item.opfRelLoc)
+    def _add(self, entry):
+        if entry.parent is None:
+            self._entries.append(entry)
+        else:
+            entry.parent.children.append(entry)
+        if entry.id:
+            self._byId.setdefault(entry.id, entry)
 
+    def _index(self):
+        """(item, fragment) index, filled once the targets of every entry are known (Internal only)"""
+        if self._entries is None:
+            self._parse()
+        if not self._byTarget:
+            for entry in self:
+                if entry.item is not None:
+                    self._byTarget.setdefault((entry.item, entry.fragment), entry)
+                    self._byTarget.setdefault((entry.item, None), entry)
+        return self._byTarget
 
-    def close(self):
-        # destory tempfiles when done
-        if self.tmpLocation:
-            shutil.rmtree(self.tmpLocation)
+    @property
+    def entries(self):
+        if self._entries is None:
+            self._parse()
+        return self._entries
 
+    def __iter__(self):
+        """every tocEntry in document order"""
+        for entry in self.entries:
+            for descendant in entry.walk():
+                yield descendant
 
-class epubFile(object):
-    """docstring for epubFile"""
-    def __enter__(self, path=None, openFor="r"):
-        return self
+    def __len__(self):
+        return sum(1 for entry in self)
 
-    def __init__(self, path=None, openFor="r"):
-        self.path = path
-        self.info = epubInfo(self.path)
-        self.tmpLocation = None
+    def getEntry(self, id):
+        """tocEntry by navPoint id, None if there is none"""
+        if self._entries is None:
+            self._parse()
+        return self._byId.get(id)
 
-    def __del__(self):
-        pass
+    def find(self, item, fragment=None):
+        """tocEntry pointing at item (and fragment, if given), None if there is none"""
+        return self._index().get((item, fragment))
 
-    def __exit__(self, type, value, traceback):
-        self.info.close()
+    def locate(self, item, fragment=None):
+        """tocEntry for the location, i.e. the chapter it is in
+
+        an exact target is preferred, otherwise the entry of the item, otherwise the entry of the closest
+        preceding spine item that has one
+        """
+        index = self._index()
+        entry = index.get((item, fragment)) if fragment else None
+        if entry is None:
+            entry = index.get((item, None))
+        if entry is None:
+            if self._chapters is None:
+                self._chapters = {}
+                current = None
+                for spineItem in self.spine:
+                    current = index.get((spineItem, None), current)
+                    self._chapters[spineItem] = current
+            entry = self._chapters.get(item)
+        return entry
+
+
+# tags and attributes of XML content documents, matched on the raw bytes
+_tagPattern = re.compile(rb"<([A-Za-z][^\s/>]*)(\s[^>]*)?>")
+_attrPattern = re.compile(rb"([^\s=/]+)\s*=\s*(?:\"([^\"]*)\"|'([^']*)')")
+
+
+class idIndex(object):
+    """fragment ID declarations and the references pointing at them, for every XML content document of a book
+
+    built in a single pass (see epubInfo.getIdIndex)
+    """
+    def __init__(self, contents):
+        self.contents = contents
+
+        # (item, fragment id) -> item declaring it, and fragment id -> items declaring it
+        self.declarations = {}
+        self.ids = {}
+
+        # (target item, fragment id) -> [(item, attribute), ...] referencing it
+        self.references = {}
+
+        # [(item, attribute, href), ...] of references whose target item or fragment doesn't exist
+        self.dangling = []
+
+        self.update()
+
+    def _isContent(self, item):
+        return item.mimetype.endswith("+xml") or item.mimetype.endswith("xhtml") or item.mimetype.endswith("html")
+
+    def update(self):
+        """(re)build the index"""
+        self.declarations = {}
+        self.ids = {}
+        self.references = {}
+        self.dangling = []
+
+        # raw references, resolved once every declaration is known
+        pending = []
+        for item in self.contents.contents:
+            if not item.opf or not self._isContent(item):
+                continue
+            content = item.read()
+            base = posixpath.dirname(item.rootRelLoc)
+            for tag in _tagPattern.finditer(content):
+                if not tag.group(2):
+                    continue
+                for attr in _attrPattern.finditer(tag.group(2)):
+                    name = attr.group(1).decode("utf-8", "replace")
+                    value = (attr.group(2) if attr.group(2) is not None else attr.group(3)).decode("utf-8", "replace")
+                    if "&" in value:
+                        import html
+                        value = html.unescape(value)
+                    if name == "id" or name == "xml:id":
+                        self.declarations[(item, value)] = item
+                        self.ids.setdefault(value, []).append(item)
+                    elif "#" in value:
+                        pending.append((item, base, name, value))
+
+        for item, base, name, value in pending:
+            path, fragment = value.split("#", 1)
+            if ":" in path.split("/", 1)[0]:
+                # external (http:, mailto: ...)
+                continue
+            fragment = urllib.parse.unquote(fragment)
+            if path:
+                try:
+                    target = self.contents.getItemFromRoot(posixpath.join(base, path))
+                except epubError:
+                    self.dangling.append((item, name, value))
+                    continue
+            else:
+                target = item
+            self.references.setdefault((target, fragment), []).append((item, name))
+            if (target, fragment) not in self.declarations:
+                self.dangling.append((item, name, value))
+
+    def find(self, fragment):
+        """items declaring fragment and the (item, attribute) references pointing at it"""
+        declarations = self.ids.get(fragment, [])
+        references = []
+        for item in declarations:
+            references.extend(self.references.get((item, fragment), []))
+        return {"declarations": declarations, "references": references}
+
+
+class textBlock(object):
+    """run of plain text from a content document, see epubInfo.iterText"""
+    __slots__ = ("item", "anchor", "offset", "text")
+
+    def __init__(self, item, anchor, offset, text):
+        # epubItem the text was read from
+        self.item = item
+
+        # last fragment id declared before the text (None at the start of the item)
+        self.anchor = anchor
+
+        # offset of the text in the plain text of the item
+        self.offset = offset
+
+        self.text = text
+
+    def __repr__(self):
+        return "<textBlock %s#%s @%d %r>" % (self.item.rootRelLoc, self.anchor or "", self.offset, self.text[:40])
+
+
+# elements that end a run of text, and elements whose text isn't part of the content
+_blockTags = frozenset(("address", "article", "aside", "blockquote", "br", "caption", "dd", "div", "dl", "dt",
+                        "figcaption", "figure", "footer", "h1", "h2", "h3", "h4", "h5", "h6", "header", "hr", "li",
+                        "main", "nav", "ol", "p", "pre", "section", "table", "td", "th", "tr", "ul"))
+_skipTags = frozenset(("head", "script", "style", "title"))
+
+# encoding declared by the xml declaration or a meta tag at the start of a document
+_encodingPattern = re.compile(rb"""^[^>]*?encoding\s*=\s*["']([A-Za-z0-9._-]+)|<meta[^>]+charset\s*=\s*["']?([A-Za-z0-9._-]+)""", re.I)
+
+
+class _textParser(object):
+    """incremental markup stripper collecting textBlocks (Internal only)
+
+    text is cut at block elements, or after maxBlock characters so a block never grows unbounded
+    """
+    def __init__(self, item, maxBlock):
+        import html.parser
+        self.parser = html.parser.HTMLParser(convert_charrefs=True)
+        self.parser.handle_starttag = self.handle_starttag
+        self.parser.handle_endtag = self.handle_endtag
+        self.parser.handle_data = self.handle_data
+        self._item = item
+        self._maxBlock = maxBlock
+
+        # finished textBlocks, emptied by the caller after every feed()
+        self.blocks = []
+
+        self._anchor = None
+        self._offset = 0
+        self._skip = 0
+        self._text = []
+        self._size = 0
+
+    def feed(self, data):
+        self.parser.feed(data)
+
+    def close(self):
+        self.parser.close()
+
+    def flush(self):
+        text = " ".join("".join(self._text).split())
+        self._text = []
+        self._size = 0
+        if text:
+            self.blocks.append(textBlock(self._item, self._anchor, self._offset, text))
+            self._offset += len(text) + 1
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _skipTags:
+            self._skip += 1
+        elif tag in _blockTags:
+            self.flush()
+        for name, value in attrs:
+            if (name == "id" or name == "xml:id") and value:
+                self.flush()
+                self._anchor = value
+                break
+
+    def handle_endtag(self, tag):
+        if tag in _skipTags:
+            self._skip = max(self._skip - 1, 0)
+        elif tag in _blockTags:
+            self.flush()
+
+    def handle_data(self, data):
+        if self._skip:
+            return
+        self._text.append(data)
+        self._size += len(data)
+        if self._size >= self._maxBlock:
+            self.flush()
+
+
+def _sniffEncoding(data):
+    """encoding of a document from its first bytes (Internal only)"""
+    data = bytes(data[:1024])
+    if data.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    if data.startswith(codecs.BOM_UTF16_LE) or data.startswith(codecs.BOM_UTF16_BE):
+        return "utf-16"
+    match = _encodingPattern.search(data)
+    if match:
+        encoding = (match.group(1) or match.group(2)).decode("ascii")
+        try:
+            codecs.lookup(encoding)
+            return encoding
+        except LookupError:
+            pass
+    return "utf-8"
+
+
+def _itemText(item, chunkSize=65536, maxBlock=65536):
+    """textBlocks of a content document, read chunk by chunk (Internal only)"""
+    parser = _textParser(item, maxBlock)
+    decoder = None
+    for chunk in item.iterChunks(chunkSize):
+        if decoder is None:
+            decoder = codecs.getincrementaldecoder(_sniffEncoding(chunk))("replace")
+        parser.feed(decoder.decode(chunk))
+        for block in parser.blocks:
+            yield block
+        del parser.blocks[:]
+    if decoder is not None:
+        parser.feed(decoder.decode(b"", True))
+    parser.close()
+    parser.flush()
+    for block in parser.blocks:
+        yield block
+
+
+class metaCache(object):
+    """persistent on-disk cache of metadata-only reads
+
+    entries are keyed by path and checked against the file size and mtime, when those have changed the
+    central directory CRCs of container.xml and the OPF decide if the entry still holds (no XML is read).
+    the least recently used entries are evicted once the stored data exceeds maxBytes.
+    """
+    def __init__(self, path, maxBytes=64 * 1024 * 1024):
+        import sqlite3
+        self.path = path
+        self.maxBytes = maxBytes
+
+        # counters for this instance
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # last use of entries hit since the last write, flushed lazily so hits stay read-only
+        self.used = {}
+
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS books (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, "
+                        "opf TEXT, containercrc INTEGER, opfcrc INTEGER, data TEXT, bytes INTEGER, used REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS books_used ON books (used)")
+
+        # running total of the stored bytes, kept by triggers so put() never sums the table
+        self.db.execute("BEGIN IMMEDIATE")
+        self.db.execute("CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER)")
+        self.db.execute("INSERT OR IGNORE INTO totals SELECT 0, COALESCE(SUM(bytes), 0) FROM books")
+        self.db.execute("CREATE TRIGGER IF NOT EXISTS books_insert AFTER INSERT ON books "
+                        "BEGIN UPDATE totals SET bytes = bytes + new.bytes WHERE id = 0; END")
+        self.db.execute("CREATE TRIGGER IF NOT EXISTS books_delete AFTER DELETE ON books "
+                        "BEGIN UPDATE totals SET bytes = bytes - old.bytes WHERE id = 0; END")
+        self.db.execute("CREATE TRIGGER IF NOT EXISTS books_update AFTER UPDATE OF bytes ON books "
+                        "BEGIN UPDATE totals SET bytes = bytes - old.bytes + new.bytes WHERE id = 0; END")
+        self.db.commit()
+
+    def _crcs(self, path, opfLocation):
+        """central directory CRCs of container.xml and the OPF (None if unreadable)"""
+        try:
+            archive = zipfile.ZipFile(path, "r")
+        except Exception:
+            return None
+        try:
+            return archive.getinfo("META-INF/container.xml").CRC, archive.getinfo(opfLocation).CRC
+        except KeyError:
+            return None
+        finally:
+            archive.close()
+
+    def get(self, path):
+        """cached entry for path or None"""
+        import json
+        path = os.path.abspath(path)
+        row = self.db.execute("SELECT size, mtime, opf, containercrc, opfcrc, data FROM books WHERE path = ?", (path,)).fetchone()
+        try:
+            stat = os.stat(path)
+        except OSError:
+            row = None
+        if row is None:
+            self.misses += 1
+            return None
+        size, mtime, opfLocation, containercrc, opfcrc, data = row
+        if (size, mtime) != (stat.st_size, stat.st_mtime_ns):
+            # the file was touched, it only matters if the container or OPF changed
+            if self._crcs(path, opfLocation) != (containercrc, opfcrc):
+                self.invalidate(path)
+                self.misses += 1
+                return None
+            self.db.execute("UPDATE books SET size = ?, mtime = ? WHERE path = ?", (stat.st_size, stat.st_mtime_ns, path))
+            self.db.commit()
+        self.used[path] = time.time()
+        self.hits += 1
+        return json.loads(data)
+
+    def put(self, path, entry, containercrc, opfcrc):
+        """store entry ({"opfLocation", "meta", "summary", "manifest"}) for path"""
+        import json
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        data = json.dumps(entry)
+        # delete then insert, a REPLACE doesn't fire the delete trigger
+        self.db.execute("DELETE FROM books WHERE path = ?", (path,))
+        self.db.execute("INSERT INTO books VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (path, stat.st_size, stat.st_mtime_ns, entry["opfLocation"], containercrc, opfcrc, data, len(data), time.time()))
+        self._evict()
+        self.db.commit()
+
+    def flush(self):
+        """write out the last use of entries that were hit"""
+        if self.used:
+            self.db.executemany("UPDATE books SET used = ? WHERE path = ?", [(used, path) for path, used in self.used.items()])
+            self.used = {}
+            self.db.commit()
+
+    def _evict(self):
+        """drop least recently used entries until the cache fits in maxBytes"""
+        if self.used:
+            self.db.executemany("UPDATE books SET used = ? WHERE path = ?", [(used, path) for path, used in self.used.items()])
+            self.used = {}
+        total = self._total()
+        while total > self.maxBytes:
+            # oldest entries first, a batch at a time
+            rows = self.db.execute("SELECT path, bytes FROM books ORDER BY used LIMIT 64").fetchall()
+            if not rows:
+                break
+            for path, size in rows:
+                if total <= self.maxBytes:
+                    break
+                self.db.execute("DELETE FROM books WHERE path = ?", (path,))
+                total -= size
+                self.evictions += 1
+
+    def _total(self):
+        """bytes of stored data (Internal only)"""
+        return self.db.execute("SELECT bytes FROM totals WHERE id = 0").fetchone()[0]
+
+    def invalidate(self, path):
+        """forget the entry for path"""
+        path = os.path.abspath(path)
+        self.used.pop(path, None)
+        self.db.execute("DELETE FROM books WHERE path = ?", (path,))
+        self.db.commit()
+
+    def clear(self):
+        """forget every entry"""
+        self.used = {}
+        self.db.execute("DELETE FROM books")
+        self.db.commit()
+
+    def stats(self):
+        """hit/miss/eviction counters and current size"""
+        count = self.db.execute("SELECT COUNT(*) FROM books").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": count, "bytes": self._total()}
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+
+class openStats(object):
+    """wall time, inflated bytes and item counts of the phases of opening a book
+
+    phases are "directory" (zip central directory), "contents" (epubItems and their lookup directories),
+    "container", "opf" (parsing), "manifest", "spine" and "guide" (linking), "meta" and "cache" (metaCache
+    lookups). the lazily built parts are recorded when they are built. hook, if given, is called as
+    hook(phase, seconds, bytes, items) for every phase
+    """
+    def __init__(self, hook=None):
+        self.hook = hook
+
+        # phase -> [seconds, bytes, items], in the order the phases first ran
+        self.phases = collections.OrderedDict()
+
+    def record(self, phase, start, bytes=0, items=0):
+        """add a phase that started at start (a time.perf_counter() value), returns the current time"""
+        now = time.perf_counter()
+        entry = self.phases.get(phase)
+        if entry is None:
+            entry = self.phases[phase] = [0.0, 0, 0]
+        entry[0] += now - start
+        entry[1] += bytes
+        entry[2] += items
+        if self.hook is not None:
+            self.hook(phase, now - start, bytes, items)
+        return now
+
+    @property
+    def total(self):
+        return sum(entry[0] for entry in self.phases.values())
+
+    def asDict(self):
+        """phase -> {"seconds", "bytes", "items"}, plus the "total" seconds and bytes"""
+        result = dict((phase, {"seconds": entry[0], "bytes": entry[1], "items": entry[2]}) for phase, entry in self.phases.items())
+        result["total"] = {"seconds": self.total, "bytes": sum(entry[1] for entry in self.phases.values())}
+        return result
+
+
+class statsAggregator(object):
+    """collects the openStats of many books (i.e. of a library scan) for percentiles and the slowest books"""
+    def __init__(self):
+        # phase -> [(seconds, path), ...]
+        self.samples = {}
+
+    def add(self, path, stats):
+        """add the openStats of a book, or its asDict() (as found in scan records)"""
+        if isinstance(stats, openStats):
+            stats = stats.asDict()
+        for phase, entry in stats.items():
+            self.samples.setdefault(phase, []).append((entry["seconds"], path))
+
+    def addRecord(self, record):
+        """add a scanLibrary record made with timings=True"""
+        if record.get("timings"):
+            self.add(record["path"], record["timings"])
+
+    def percentiles(self, phase="total", points=(50, 90, 99)):
+        """point -> seconds (nearest rank) of a phase"""
+        values = sorted(seconds for seconds, path in self.samples.get(phase, []))
+        if not values:
+            return {}
+        return dict((point, values[min(len(values) - 1, max(0, int(-(-point * len(values) // 100)) - 1))]) for point in points)
+
+    def slowest(self, phase="total", count=10):
+        """[(seconds, path), ...] of the slowest books in a phase"""
+        return sorted(self.samples.get(phase, []), reverse=True)[:count]
+
+    def export(self, points=(50, 90, 99)):
+        """phase -> {"count", "mean", "max", "p50", ...}"""
+        result = {}
+        for phase, samples in self.samples.items():
+            total = sum(seconds for seconds, path in samples)
+            entry = {"count": len(samples), "mean": total / len(samples), "max": max(samples)[0]}
+            for point, seconds in self.percentiles(phase, points).items():
+                entry["p%d" % point] = seconds
+            result[phase] = entry
+        return result
+
+
+class verifyReport(object):
+    """problems found by epubInfo.verify(), collected rather than raised
+
+    every problem is a dict of "kind" (archive, mimetype, container, opf, manifest, spine, guide, toc, metadata
+    or crc), "item" (root relative path or OPF id, None for the book), "message" and "severity" (error or warning)
+    """
+    def __init__(self, path):
+        self.path = path
+        self.problems = []
+
+        # number of members, manifest, spine and guide entries checked
+        self.checked = {"members": 0, "manifest": 0, "spine": 0, "guide": 0}
+
+        # False when verification stopped at the first error (failFast)
+        self.complete = True
+
+    def add(self, kind, item, message, severity="error"):
+        self.problems.append({"kind": kind, "item": item, "message": message, "severity": severity})
+
+    @property
+    def errors(self):
+        return [problem for problem in self.problems if problem["severity"] == "error"]
+
+    @property
+    def ok(self):
+        """True if no errors were found (warnings are fine)"""
+        return not self.errors
+
+    def asDict(self):
+        return {"path": self.path, "ok": self.ok, "complete": self.complete, "checked": self.checked, "problems": self.problems}
+
+
+class epubInfo(object):
+    """Information about and Epub file
+
+    should only really be publicly used for reading data with no intention of writing. if you plan on writing you should be using epubFile() instead
+    """
+    def __init__(self, path, openFor="r", mode="full", cache=None, readCache=None, hook=None):
+        # timings of the phases of opening the book (see openStats, hook is called after every phase)
+        self.stats = openStats(hook)
+
+        # epubfile path (None when the book is read from a buffer or a file object)
+        self.path = None
+
+        # memoryview of the book when it is given as bytes, bytearray, memoryview or mmap
+        self.buffer = None
+
+        # file object the book is read from (given, or over buffer)
+        self.fileobj = None
+
+        if isinstance(path, (str, os.PathLike)):
+            self.path = os.path.abspath(path)
+        elif isinstance(path, (bytes, bytearray, memoryview, mmap.mmap)):
+            self.buffer = memoryview(path).cast("B")
+            self.fileobj = _bufferFile(self.buffer)
+        elif hasattr(path, "read") and hasattr(path, "seek"):
+            self.fileobj = path
+        else:
+            raise epubError("Unable to read an epub from %r" % type(path).__name__)
+
+        # Contents of (imagineary)? epubfile
+        self.contents = epubContents([])
+
+        # itemCache of decompressed items (optional)
+        self.contents.readCache = readCache
+
+        # container file (becomes container item I think at the moment and this needs to be fixed)
+        self.container = "META-INF/container.xml"
+
+        # zipfile object
+        self.archive = None
+
+        # location of OPF file
+        self.opfLocation = None
+
+        # loction of extracted temporary files
+        self.tmpLocation = None
+
+        # open for reading/writing
+        self.openFor = openFor
+
+        # "full" links every item, "meta" only reads the container and the OPF metadata,
+        # "summary" does the same and fills summary, "verify" records problems instead of raising (see verify())
+        self.mode = mode
+
+        # metaCache used by the metadata-only mode
+        self.cache = cache
+
+        # manifest/spine summary (only filled in summary mode, or in metadata-only mode when caching)
+        self.summary = None
+
+        # idIndex, see getIdIndex()
+        self._idIndex = None
+
+        # OPF, NCX and Meta data, built on first use (see the properties below)
+        self._opf = None
+        self._ncx = None
+        self._meta = None
+
+        # problems found by verify(), "verify" mode records the ones found while opening instead of raising
+        self.report = None
+
+        if self.mode in ("meta", "summary"):
+            self._readMeta()
+            return
+
+        if self.mode == "verify":
+            self.report = verifyReport(self._name())
+            try:
+                self.update()
+                if not self.archive and not (self.path and os.path.isdir(self.path)):
+                    raise epubError("'%s' is not an epub archive" % self._name())
+            except epubError as e:
+                self.report.add("archive", None, str(e))
+                return
+            try:
+                self.opfLocation = self._getOPFLocation()
+            except epubError as e:
+                self.report.add("container", "META-INF/container.xml", str(e))
+            return
+
+        # update and get opf location from file container
+        self.update()
+        self.opfLocation = self._getOPFLocation()
+
+    @property
+    def contentsArr(self):
+        """every epubItem of the book, linked to the OPF (which is read for it, see namelist())"""
+        self.opf
+        return self.contents.contents
+
+    def namelist(self):
+        """root relative paths of every item, without reading the OPF"""
+        return [item.rootRelLoc for item in self.contents.contents]
+
+    @property
+    def opf(self):
+        """OPF data, read on first use (None in metadata-only mode)"""
+        if self._opf is None and self.mode not in ("meta", "summary"):
+            self._opf = OPF(self.opfLocation, self.contents, self.stats)
+        return self._opf
+
+    @opf.setter
+    def opf(self, value):
+        self._opf = value
+
+    @property
+    def ncx(self):
+        """NCX (table of contents) data, made on first use (None in metadata-only mode)"""
+        if self._ncx is None and self.mode not in ("meta", "summary"):
+            opf = self.opf
+            self._ncx = NCX(opf.ncxLocation, self.contents, opf.navLocation, opf.spine)
+        return self._ncx
+
+    @ncx.setter
+    def ncx(self, value):
+        self._ncx = value
+
+    @property
+    def meta(self):
+        """Meta data, made on first use"""
+        if self._meta is None and self.mode not in ("meta", "summary"):
+            metadata = self.opf.metadata
+            start = time.perf_counter()
+            self._meta = META(metadata, self.ncx.ncxdom, self.contents)
+            self.stats.record("meta", start, 0, len(self._meta.data))
+        return self._meta
+
+    @meta.setter
+    def meta(self, value):
+        self._meta = value
+
+    def _isArchive(self):
+        """this is somewhat retarded but.... meh! it deffinately made sense at the time"""
+        if self.fileobj is not None:
+            return zipfile.is_zipfile(self.fileobj)
+        if self.path and os.path.exists(self.path):
+            return zipfile.is_zipfile(self.path)
+
+    def _name(self):
+        return self.path or "<%s>" % type(self.fileobj if self.buffer is None else self.buffer).__name__
+
+    def _openArchive(self):
+        """zipfile object of the book, read from its path or its file object (Internal only)"""
+        start = time.perf_counter()
+        try:
+            archive = zipfile.ZipFile(self.fileobj if self.fileobj is not None else self.path, "r")
+        except (zipfile.BadZipFile, OSError) as e:
+            raise epubError("'%s' is not an epub archive: %s" % (self._name(), e))
+        self.stats.record("directory", start, 0, len(archive.filelist))
+        return archive
+
+    def _readArchive(self):
+        """read contents of archive into contents"""
+        # create zipfile object
+        self.archive = self._openArchive()
+        self.contents.source = _zipSource(self.archive, self.buffer)
+        start = time.perf_counter()
+
+        # build epubItems from contents of zipfile
+        for member in self.archive.infolist():
+            item = epubItem()
+            item.archive = self.archive
+            item._rootRelLoc = member.filename
+            item.compressiontype = member.compress_type
+            item.lastmodified = member.date_time
+            item.compressed_size = member.compress_size
+            item.file_size = member.file_size
+
+            # add this epubItem to the contents array (and its directories)
+            self.contents.add(item)
+
+            # if this item is the container file then cheesecake
+            if item.rootRelLoc == self.container:
+                self.container = item
+        self.stats.record("contents", start, 0, len(self.contents.contents))
+
+    def _readMeta(self):
+        """read only the container and the OPF metadata, no epubItems are built (Internal only)"""
+        if self.cache and self.path:
+            start = time.perf_counter()
+            entry = self.cache.get(self.path)
+            # the cache only revalidates the container and the OPF, summary sizes are taken from the central directory
+            if entry and self.mode == "summary" and "manifest" not in entry:
+                entry = None
+            self.stats.record("cache", start, 0, 1 if entry else 0)
+            if entry:
+                self.opfLocation = entry["opfLocation"]
+                self.summary = entry["summary"]
+                self.meta = META([], None, None, entry["meta"])
+                if self.mode == "summary":
+                    self.archive = self._openArchive()
+                    self.summary["size"] = sum(self._rootSize(name) for name in entry["manifest"])
+                return
+
+        if self._isArchive():
+            self.archive = self._openArchive()
+        elif not self.path or not os.path.isdir(self.path):
+            raise epubError("'%s' is not an epub archive" % self._name())
+        caching = self.cache and self.archive and self.path
+        summarize = caching or self.mode == "summary"
+        self.opfLocation = self._getOPFLocation()
+        start = time.perf_counter()
+        try:
+            root = self._openRoot(self.opfLocation)
+        except:
+            raise epubError("There is no item named '%s' in this epubfile" % self.opfLocation)
+        # stop parsing once the metadata block has been read (unless we need a summary)
+        try:
+            parsed = _opfParser(metaOnly=not summarize).parse(root)
+        except:
+            raise epubError("'%s' is invalid XML" % self.opfLocation)
+        finally:
+            root.close()
+        start = self.stats.record("opf", start, self._rootSize(self.opfLocation), len(parsed.metadata) + len(parsed.manifest))
+        self.meta = META(parsed.metadata, None, None)
+        self.stats.record("meta", start, 0, len(self.meta.data))
+
+        if summarize:
+            hrefs = dict((node.get("id"), node.get("href")) for node in parsed.manifest)
+            opfDir = posixpath.dirname(self.opfLocation)
+            manifest = [_pathKey(opfDir + "/" + href if opfDir else href) for href in hrefs.values() if href]
+            self.summary = {"manifest": len(parsed.manifest),
+                            "spine": [hrefs.get(node.get("idref")) for node in parsed.spine],
+                            "linear": sum(1 for node in parsed.spine if node.get("linear") != "no"),
+                            "toc": hrefs.get(parsed.spineAttrs.get("toc"))}
+        if caching:
+            # no "size" in the cached summary, members can change without the OPF changing
+            entry = {"opfLocation": self.opfLocation, "meta": self.meta.getMetaData(), "summary": dict(self.summary),
+                     "manifest": manifest}
+            self.cache.put(self.path, entry, self.archive.getinfo(self.container).CRC, self.archive.getinfo(self.opfLocation).CRC)
+        if summarize:
+            self.summary["size"] = sum(self._rootSize(name) for name in manifest)
+
+    def _readDir(self):
+        """read contents of directory as an extracted epubfile
+
+        items are indexed from os.scandir entries and read from disk on demand (large ones through memory maps)
+        """
+        start = time.perf_counter()
+        stack = [("", self.path)]
+
+        # directories already listed, symlinked directories are followed once (no loops) and only inside the book
+        stat = os.stat(self.path)
+        listed = set([(stat.st_dev, stat.st_ino)])
+        root = os.path.join(os.path.realpath(self.path), "")
+        while stack:
+            prefix, directory = stack.pop()
+            try:
+                entries = sorted(os.scandir(directory), key=lambda entry: entry.name)
+            except OSError:
+                raise epubError("Unable to list '%s'" % directory)
+            for entry in entries:
+                name = prefix + entry.name
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    # dangling symlink
+                    continue
+                if entry.is_dir():
+                    if entry.is_symlink() and not os.path.realpath(entry.path).startswith(root):
+                        continue
+                    if (stat.st_dev, stat.st_ino) not in listed:
+                        listed.add((stat.st_dev, stat.st_ino))
+                        stack.append((name + "/", entry.path))
+                    continue
+                if not entry.is_file():
+                    continue
+                item = epubItem()
+                item._absLoc = entry.path
+                item._rootRelLoc = name
+                item.compressiontype = zipfile.ZIP_STORED
+                item.compressed_size = stat.st_size
+                item.file_size = stat.st_size
+                item.lastmodified = time.localtime(stat.st_mtime)[:6]
+
+                # add this epubItem to the contents array (and its directories)
+                self.contents.add(item)
+
+                # if this item is the container file then cheesecake
+                if name == self.container:
+                    self.container = item
+        self.stats.record("contents", start, 0, len(self.contents.contents))
+
+    def _rootSize(self, name):
+        """size of a file by its root relative path, 0 if it can't be found (Internal only)"""
+        try:
+            if self.archive:
+                return self.archive.getinfo(name).file_size
+            return os.path.getsize(os.path.join(self.path, *name.split("/")))
+        except (KeyError, OSError, TypeError):
+            return 0
+
+    def _openRoot(self, name):
+        """open a file by its root relative path in the archive or directory (Internal only)"""
+        if self.archive:
+            return self.archive.open(name)
+        if self.path and os.path.isdir(self.path):
+            return open(os.path.join(self.path, *name.split("/")), "rb")
+        raise epubError("There is no item named '%s' in this epubfile" % name)
+
+    def update(self):
+        """updates objects from source"""
+        if self._isArchive():
+            self._readArchive()
+        elif self.path and os.path.isdir(self.path):
+            self._readDir()
+        elif self.fileobj is not None:
+            raise epubError("'%s' is not an epub archive" % self._name())
+        else:
+            self.archive = None
+
+    def _getOPFLocation(self):
+        """Retreive OPF location from the container.xml file found in META-INF (Internal only)"""
+        began = time.perf_counter()
+        location = getattr(self.container, "rootRelLoc", self.container)
+        try:
+            container = self._openRoot(location)
+        except:
+            raise epubError("META-INF/container.xml appears to be missing :(")
+
+        # the first rootfile is all we need
+        rootfiles = []
+
+        def start(name, attrs):
+            if name == "rootfile":
+                rootfiles.append(attrs)
+                raise _opfStop()
+
+        parser = xml.parsers.expat.ParserCreate()
+        parser.StartElementHandler = start
+        try:
+            parser.ParseFile(container)
+        except _opfStop:
+            pass
+        except:
+            raise epubError("META-INF/container.xml is invalid XML")
+        finally:
+            container.close()
+
+        if not rootfiles:
+            raise epubError("META-INF/container.xml is improperly formatted (unable to find rootfile)")
+
+        self.stats.record("container", began, self._rootSize(location), 1)
+        return rootfiles[0].get("full-path", "")
+
+    def verify(self, workers=None, failFast=False):
+        """check the structure of the book and the CRCs of every archive member, returns a verifyReport
+
+        the container, OPF, manifest, spine, guide and toc entries are resolved through epubContents first,
+        then the members are read (and their CRCs checked) by workers threads. with failFast verification
+        stops at the first error. best used on a book opened with mode="verify", which doesn't raise on
+        a broken container
+        """
+        report = self.report
+        if report is None:
+            report = self.report = verifyReport(self._name())
+        if report.errors and (failFast or report.errors[0]["kind"] == "archive"):
+            report.complete = not failFast
+            return report
+
+        for check in (self._verifyMimetype, self._verifyOPF):
+            check(report)
+            if failFast and report.errors:
+                report.complete = False
+                return report
+
+        if self.archive:
+            self._verifyMembers(report, workers, failFast)
+        return report
+
+    def _verifyMimetype(self, report):
+        """the mimetype has to be the first member, stored and say application/epub+zip (Internal only)"""
+        if not self.archive:
+            return
+        members = self.archive.infolist()
+        if not members or members[0].filename != "mimetype":
+            if "mimetype" not in self.archive.NameToInfo:
+                report.add("mimetype", "mimetype", "there is no mimetype file")
+                return
+            report.add("mimetype", "mimetype", "mimetype is not the first member of the archive", "warning")
+        info = self.archive.getinfo("mimetype")
+        if info.compress_type != zipfile.ZIP_STORED:
+            report.add("mimetype", "mimetype", "mimetype is compressed", "warning")
+        try:
+            content = self.contents.getItemFromRoot("mimetype").read()
+        except epubError as e:
+            report.add("mimetype", "mimetype", str(e))
+            return
+        if content.strip() != b"application/epub+zip":
+            report.add("mimetype", "mimetype", "mimetype is %r, not 'application/epub+zip'" % content[:40])
+
+    def _verifyOPF(self, report):
+        """resolve the OPF and its manifest, spine, guide and toc entries (Internal only)"""
+        if not self.opfLocation:
+            return
+        try:
+            opfItem = self.contents.getItemFromRoot(self.opfLocation)
+        except epubError:
+            report.add("opf", self.opfLocation, "There is no item named '%s' in this epubfile" % self.opfLocation)
+            return
+        try:
+            parsed = _opfParser().parse(io.BytesIO(opfItem.read()))
+        except epubError as e:
+            report.add("opf", self.opfLocation, str(e))
+            return
+        except xml.parsers.expat.ExpatError as e:
+            report.add("opf", self.opfLocation, "'%s' is invalid XML: %s" % (self.opfLocation, e))
+            return
+
+        opfDir = posixpath.dirname(self.opfLocation)
+        ids = {}
+        for node in parsed.manifest:
+            report.checked["manifest"] += 1
+            href = node.get("href")
+            name = node.get("id") or href
+            if not href:
+                report.add("manifest", name, "manifest item has no href")
+                continue
+            if not node.get("id"):
+                report.add("manifest", name, "manifest item '%s' has no id" % href)
+            elif node["id"] in ids:
+                report.add("manifest", name, "duplicate manifest id '%s'" % node["id"])
+            if not node.get("media-type"):
+                report.add("manifest", name, "manifest item '%s' has no media-type" % href, "warning")
+            if ":" in href.split("/", 1)[0]:
+                # remote resource
+                ids[node.get("id")] = None
+                continue
+            try:
+                ids[node.get("id")] = self.contents.getItemFromRoot(opfDir + "/" + href if opfDir else href)
+            except epubError:
+                ids[node.get("id")] = None
+                report.add("manifest", name, "'%s' is not in the archive" % href)
+
+        if not parsed.spine:
+            report.add("spine", None, "the spine is empty")
+        for node in parsed.spine:
+            report.checked["spine"] += 1
+            idref = node.get("idref", "")
+            if idref not in ids:
+                report.add("spine", idref, "spine itemref '%s' is not in the manifest" % idref)
+
+        toc = parsed.spineAttrs.get("toc")
+        if toc and toc not in ids:
+            report.add("toc", toc, "spine toc '%s' is not in the manifest" % toc)
+
+        for node in parsed.guide:
+            report.checked["guide"] += 1
+            href = node.get("href", "")
+            path = href.split("#", 1)[0]
+            try:
+                self.contents.getItemFromRoot(opfDir + "/" + path if opfDir else path)
+            except epubError:
+                report.add("guide", href, "guide reference '%s' is not in the archive" % href)
+
+        meta = META(parsed.metadata, None, None)
+        for name, template in meta.templates.items():
+            if meta._testFlag(template["flags"], META.REQUIRED) and meta.getMetaData(name) is None:
+                report.add("metadata", name, "required metadata '%s' is missing" % name, "warning")
+
+    def _verifyMembers(self, report, workers=None, failFast=False):
+        """read every archive member in threads, checking CRCs (Internal only)"""
+        import concurrent.futures
+
+        def check(item):
+            try:
+                for chunk in item.iterChunks(1024 * 1024):
+                    pass
+            except epubError as e:
+                return str(e)
+            return None
+
+        items = [item for item in self.contents.contents if not item.rootRelLoc.endswith("/")]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers or min(8, os.cpu_count() or 1)) as executor:
+            futures = dict((executor.submit(check, item), item) for item in items)
+            for future in concurrent.futures.as_completed(futures):
+                report.checked["members"] += 1
+                message = future.result()
+                if message is not None:
+                    report.add("crc", futures[future].rootRelLoc, message)
+                    if failFast:
+                        report.complete = False
+                        for pending in futures:
+                            pending.cancel()
+                        break
+
+    def fingerprint(self):
+        """bookFingerprint of the manifest items, from the CRCs and sizes in the zip central directory
+
+        names are taken relative to the OPF, the mimetype, the container, the OPF itself and member timestamps
+        don't take part, so re-zipped or renamed copies of a book get the same fingerprint. nothing but the OPF
+        is inflated (extracted books are read to compute their CRCs)
+        """
+        opfDir = posixpath.dirname(self.opfLocation)
+        if self._opf is not None:
+            # the linked OPF drops its parsed nodes, its manifest items know both paths
+            hrefs = [(item.opfRelLoc, item.rootRelLoc) for item in self._opf.manifest]
+        else:
+            try:
+                root = self._openRoot(self.opfLocation)
+            except Exception:
+                raise epubError("There is no item named '%s' in this epubfile" % self.opfLocation)
+            try:
+                manifest = _opfParser().parse(root).manifest
+            except (epubError, xml.parsers.expat.ExpatError):
+                raise epubError("'%s' is invalid XML" % self.opfLocation)
+            finally:
+                root.close()
+            hrefs = [(node["href"], opfDir + "/" + node["href"] if opfDir else node["href"])
+                     for node in manifest if node.get("href") and ":" not in node["href"].split("/", 1)[0]]
+
+        if self.archive:
+            infos = dict((_pathKey(info.filename), info) for info in self.archive.infolist())
+        members = {}
+        for href, rootpath in hrefs:
+            key = _pathKey(rootpath)
+            if self.archive:
+                info = infos.get(key)
+                if info is None:
+                    continue
+                members[_pathKey(href)] = (info.CRC, info.file_size)
+            else:
+                try:
+                    member = self._openRoot(key)
+                except OSError:
+                    continue
+                crc = size = 0
+                with member:
+                    for chunk in iter(lambda: member.read(1024 * 1024), b""):
+                        crc = zlib.crc32(chunk, crc)
+                        size += len(chunk)
+                members[_pathKey(href)] = (crc, size)
+        return bookFingerprint(self._name(), members)
+
+    def getIdIndex(self):
+        """idIndex of the book, built on first use"""
+        if self._idIndex is None:
+            self._idIndex = idIndex(self.contents)
+        return self._idIndex
+
+    def findIDreferences(self, *query):
+        """declarations and references of the given fragment ids (every declared id if none are given)
+
+        returns a dict of id -> {"declarations": [items], "references": [(item, attribute), ...]}
+        """
+        index = self.getIdIndex()
+        return dict((que, index.find(que)) for que in (query or sorted(index.ids)))
+
+    def iterText(self, linearOnly=False, chunkSize=65536, maxBlock=65536):
+        """plain text of the book in reading order, as textBlocks tagged with their item, anchor and offset
+
+        spine items are read and parsed chunkSize bytes at a time, so memory stays bounded whatever the size
+        of a chapter. non-linear items (linear="no" in the spine) are skipped when linearOnly is set.
+        """
+        for item in self.opf.spine:
+            if linearOnly and not item.linear:
+                continue
+            if "html" not in item.mimetype and not item.mimetype.endswith("xml"):
+                continue
+            for block in _itemText(item, chunkSize, maxBlock):
+                yield block
+
+    def setMetaData(self, name, value):
+        """change the metadata matching a META template in the OPF, written out by save()
+
+        value is a string (a list for repeated elements), an epubItem for item references or None to remove the elements.
+        an element value can also be a tuple laid out like getMetaData() returns it, the text followed by the values of
+        the template's value attributes (i.e. ("urn:isbn:0123456789", "ISBN") for "identifer"), which is needed to
+        create elements whose template requires an attribute without giving its value (identifer, date)
+        """
+        import xml.dom.minidom
+        if not name in self.meta.templates:
+            raise epubError("No matching template can be found for %s" % name)
+        template = self.meta.templates[name]
+        opfItem = self.contents.getItemFromRoot(self.opfLocation)
+        try:
+            dom = xml.dom.minidom.parseString(opfItem.read())
+            metadata = dom.getElementsByTagName("metadata")[0]
+        except Exception:
+            raise epubError("'%s' has no readable metadata" % self.opfLocation)
+
+        attrs = template["attr"] or []
+        predicates = [(attr[0], attr[1]) for attr in attrs]
+        if template["id"]:
+            predicates.append(("id", template["id"]))
+        matches = [node for node in metadata.getElementsByTagName(template["name"])
+                   if all(node.hasAttribute(attr_name) and (not attr_value or node.getAttribute(attr_name) == attr_value)
+                          for attr_name, attr_value in predicates)]
+
+        if value is None:
+            values = []
+        elif isinstance(value, list):
+            values = list(value)
+        else:
+            values = [value]
+
+        # new elements go after the last match (or the last element) with the same indentation
+        elements = [node for node in metadata.childNodes if node.nodeType == node.ELEMENT_NODE]
+        anchor = matches[-1] if matches else (elements[-1] if elements else None)
+        indent = "\n"
+        if anchor is not None and anchor.previousSibling is not None and anchor.previousSibling.nodeType == anchor.TEXT_NODE:
+            indent = anchor.previousSibling.data
+
+        flags = template["flags"] or 0
+        for i, val in enumerate(values):
+            # the parts of an element value: its text (for text templates), then its value attributes in template order
+            parts = list(val) if isinstance(val, (list, tuple)) else [val]
+            if i < len(matches):
+                node = matches[i]
+            else:
+                node = dom.createElement(template["name"])
+                for attr_name, attr_value in predicates:
+                    if attr_value:
+                        node.setAttribute(attr_name, attr_value)
+                following = anchor.nextSibling if anchor is not None else None
+                metadata.insertBefore(dom.createTextNode(indent), following)
+                metadata.insertBefore(node, following)
+                anchor = node
+            if flags & META.TEXTVALUE:
+                while node.firstChild:
+                    node.removeChild(node.firstChild)
+                node.appendChild(dom.createTextNode(str(parts.pop(0))))
+            for attr_name, attr_value, attr_flags in attrs:
+                attr_flags = attr_flags or 0
+                if not attr_flags & (META.ITEMVALUE | META.IDREF | META.ATTRVALUE):
+                    continue
+                part = parts.pop(0) if parts else None
+                if attr_value:
+                    # fixed by the template, already set
+                    continue
+                if part is None:
+                    if not node.hasAttribute(attr_name):
+                        raise epubError("'%s' needs a value for its %s attribute, give a tuple (see setMetaData)" % (name, attr_name))
+                    continue
+                if isinstance(part, epubItem):
+                    part = part.opfid if attr_flags & META.IDREF else part.opfRelLoc
+                node.setAttribute(attr_name, str(part))
+        for node in matches[len(values):]:
+            if node.previousSibling is not None and node.previousSibling.nodeType == node.TEXT_NODE and not node.previousSibling.data.strip():
+                metadata.removeChild(node.previousSibling)
+            metadata.removeChild(node)
+
+        data = dom.toxml(encoding="utf-8")
+        opfItem.write(data)
+        metadataNodes = _opfParser(metaOnly=True).parse(io.BytesIO(data)).metadata
+        if self.opf:
+            self.opf.metadata = metadataNodes
+        # rematch the same META so templates added with addDataTemplate are kept
+        self.meta.metadata = metadataNodes
+        self.meta.values = {}
+        self.meta.getData()
+
+    def _copyRaw(self, out, info):
+        """copy an archive member into out as its raw (still compressed) bytes (Internal only)"""
+        _zipAppendRaw(out, copy.copy(info), self.contents.source.raw(info))
+
+    def save(self, path=None):
+        """write the book to path (back to its own file by default)
+
+        only items changed through write()/setMetaData() are recompressed, every other member is copied as raw
+        compressed bytes. the mimetype goes first and stored.
+        """
+        import tempfile
+        if self.openFor != "w":
+            raise epubError("'%s' was not opened for writing" % self._name())
+        if not self.archive:
+            raise epubError("'%s' has no archive to save" % self._name())
+        if not path and not self.path:
+            raise epubError("'%s' was not read from a file, save() needs a path" % self._name())
+        target = os.path.abspath(path) if path else self.path
+        inPlace = target == self.path
+        if inPlace:
+            fd, output = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(target))
+            os.close(fd)
+            os.chmod(output, os.stat(target).st_mode & 0o7777)
+        else:
+            output = target
+
+        items = sorted(self.contents.contents, key=lambda item: item.rootRelLoc != "mimetype")
+        try:
+            with zipfile.ZipFile(output, "w") as out:
+                for item in items:
+                    info = self.archive.getinfo(item.rootRelLoc)
+                    if item.rootRelLoc == "mimetype":
+                        if item.pending is None and info.compress_type == zipfile.ZIP_STORED:
+                            self._copyRaw(out, info)
+                        else:
+                            zinfo = zipfile.ZipInfo("mimetype", info.date_time)
+                            out.writestr(zinfo, item.read(), zipfile.ZIP_STORED)
+                    elif item.pending is not None:
+                        zinfo = zipfile.ZipInfo(item.rootRelLoc, time.localtime()[:6])
+                        zinfo.external_attr = info.external_attr
+                        out.writestr(zinfo, item.pending, zipfile.ZIP_DEFLATED)
+                    else:
+                        self._copyRaw(out, info)
+        except Exception:
+            if inPlace:
+                os.remove(output)
+            raise
+
+        if inPlace:
+            # swap the saved file in and reopen it under the existing items
+            self.contents.source.close()
+            self.archive.close()
+            os.replace(output, target)
+            self.archive = zipfile.ZipFile(target, "r")
+            self.contents.source = _zipSource(self.archive)
+            for item in self.contents.contents:
+                info = self.archive.getinfo(item.rootRelLoc)
+                item.archive = self.archive
+                item.pending = None
+                item.compressiontype = info.compress_type
+                item.compressed_size = info.compress_size
+                item.file_size = info.file_size
+                item.lastmodified = info.date_time
+        return target
+
+    def close(self):
+        # destory tempfiles when done
+        import shutil
+        if self.tmpLocation:
+            shutil.rmtree(self.tmpLocation)
+        if self.contents.source:
+            self.contents.source.close()
+        if self.archive:
+            self.archive.close()
+
+    async def aclose(self, executor=None):
+        """close() run in an executor"""
+        await _asyncRun(executor, self.close)
+
+    async def aspine(self, linearOnly=False, executor=None):
+        """async iterator of (item, content) over the spine, the next item is read while the current one is used"""
+        items = [item for item in self.opf.spine if item.linear or not linearOnly]
+        if not items:
+            return
+        pending = _asyncRun(executor, items[0].read)
+        try:
+            for index, item in enumerate(items):
+                data = await pending
+                pending = _asyncRun(executor, items[index + 1].read) if index + 1 < len(items) else None
+                yield item, data
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+
+class epubFile(object):
+    """docstring for epubFile"""
+    def __enter__(self, path=None, openFor="r"):
+        return self
+
+    def __init__(self, path=None, openFor="r", mode="full", cache=None):
+        self.path = path
+        self.info = epubInfo(self.path, openFor=openFor, mode=mode, cache=cache)
+        self.tmpLocation = None
+
+    def save(self, path=None):
+        """save changes (the book must be opened with openFor="w")"""
+        return self.info.save(path)
+
+    def __del__(self):
+        pass
+
+    def __exit__(self, type, value, traceback):
+        self.info.close()
+
+
+# elements of content documents whose links are prefetched along with the document (stylesheets, images ...)
+_resourcePattern = re.compile(rb"<(?:link|img|image|script|source|audio|video)(\s[^>]*)>", re.I)
+_resourceAttrs = frozenset((b"href", b"src", b"xlink:href"))
+
+
+class readingSession(object):
+    """reader of a book in spine order that prefetches what comes next
+
+    after every read the next `ahead` linear spine items, and then the stylesheets and images they link to,
+    are read on a background thread into a bounded itemCache, so the next page turn is usually served from memory
+    """
+    def __init__(self, info, ahead=2, maxBytes=32 * 1024 * 1024):
+        self.info = info
+        self.ahead = ahead
+        self.items = [item for item in info.opf.spine if item.linear]
+        self.positions = dict((item, index) for index, item in enumerate(self.items))
+
+        # prefetched contents
+        self.buffer = itemCache(maxBytes)
+
+        # index in items of the last read spine item (-1 before the first)
+        self.position = -1
+
+        # counters: reads served from the buffer, reads that weren't, items read by the background thread
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+
+        # items waiting to be prefetched and the one being read
+        self.queue = collections.deque()
+        self.loading = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name="epub prefetch", daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _schedule(self):
+        """queue the items following position (Internal only, the condition is held)"""
+        self.queue.clear()
+        for item in self.items[self.position + 1:self.position + 1 + self.ahead]:
+            if item.pending is None and item is not self.loading and item._cacheKey() not in self.buffer.entries:
+                self.queue.append(item)
+        self.condition.notify_all()
+
+    def _resources(self, item, data):
+        """items linked from a content document that aren't buffered yet (Internal only)"""
+        found = []
+        base = posixpath.dirname(item.rootRelLoc)
+        for tag in _resourcePattern.finditer(data):
+            for attr in _attrPattern.finditer(tag.group(1)):
+                if attr.group(1).lower() not in _resourceAttrs:
+                    continue
+                href = (attr.group(2) if attr.group(2) is not None else attr.group(3)).decode("utf-8", "replace")
+                if not href or href.startswith("#") or ":" in href.split("/", 1)[0]:
+                    continue
+                try:
+                    if "&" in href:
+                        import html
+                        href = html.unescape(href)
+                    linked = self.info.contents.getItemFromRoot(posixpath.join(base, href))
+                except epubError:
+                    continue
+                if linked is not item and not linked.spine and linked not in found and linked._cacheKey() not in self.buffer.entries:
+                    found.append(linked)
+        return found
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                item = self.loading = self.queue.popleft()
+            data = None
+            try:
+                data = item.read()
+                self.buffer.put(item._cacheKey(), data)
+            except Exception:
+                # read() in the caller's thread raises it again, the prefetching goes on
+                data = None
+            finally:
+                with self.condition:
+                    self.loading = None
+                    if data is not None:
+                        self.prefetched += 1
+                    self.condition.notify_all()
+
+            # the stylesheets and images of a chapter come before the chapters after it
+            if data is not None and item.spine:
+                try:
+                    resources = self._resources(item, data)
+                except Exception:
+                    resources = []
+                with self.condition:
+                    self.queue.extendleft(reversed(resources))
+                    self.condition.notify_all()
+
+    def read(self, item):
+        """content of item, from the buffer when it was prefetched, and prefetch what follows it"""
+        key = item._cacheKey()
+        with self.condition:
+            if self.closed:
+                raise epubError("The reading session is closed")
+            if item in self.positions:
+                self.position = self.positions[item]
+                self._schedule()
+
+            # being read right now, wait for it rather than reading it twice
+            while self.loading is item:
+                self.condition.wait()
+            data = self.buffer.get(key) if item.pending is None else None
+            if data is not None:
+                self.hits += 1
+                return data
+            self.misses += 1
+        data = item.read()
+        if item.spine:
+            resources = self._resources(item, data)
+            with self.condition:
+                self.queue.extendleft(reversed(resources))
+                self.condition.notify_all()
+        return data
+
+    def next(self):
+        """(item, content) of the linear spine item after the last one read, None at the end of the book"""
+        if self.position + 1 >= len(self.items):
+            return None
+        item = self.items[self.position + 1]
+        return item, self.read(item)
+
+    def seek(self, item):
+        """continue reading at item (prefetching starts from it)"""
+        with self.condition:
+            self.position = self.positions[item] - 1
+            self._schedule()
+
+    def stats(self):
+        """hits, misses, hit rate, prefetched items and buffer size"""
+        reads = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hitRate": float(self.hits) / reads if reads else 0.0,
+                "prefetched": self.prefetched, "bytes": self.buffer.size}
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.queue.clear()
+            self.condition.notify_all()
+        self.thread.join()
+        self.buffer.clear()
+
+
+def readMetadata(path, cache=None):
+    """read the metadata of an epub without linking any of its items
+
+    returns a dict of template name -> value, item references are left as the raw OPF references.
+    cache is an optional metaCache
+    """
+    info = epubInfo(path, mode="meta", cache=cache)
+    try:
+        return info.meta.getMetaData()
+    finally:
+        info.close()
+
+
+# executor running the blocking work of the asyncio API (None: the default executor of the loop) and the
+# number of books aopen() opens at once (or keeps open, when used with "async with") per event loop
+_asyncExecutor = None
+_asyncMaxOpen = 32
+_asyncLimits = weakref.WeakKeyDictionary()
+
+
+def setAsyncExecutor(executor=None, maxOpen=None):
+    """configure the executor and the open limit used by aopen(), epubItem.aread() and friends"""
+    global _asyncExecutor, _asyncMaxOpen
+    _asyncExecutor = executor
+    if maxOpen is not None:
+        _asyncMaxOpen = maxOpen
+        _asyncLimits.clear()
+
+
+def _asyncRun(executor, func, *args, **kwargs):
+    """asyncio future of func run in executor (Internal only)"""
+    import asyncio
+    loop = asyncio.get_running_loop()
+    if kwargs:
+        func = functools.partial(func, **kwargs)
+    return loop.run_in_executor(executor or _asyncExecutor, func, *args)
+
+
+def _asyncLimit():
+    """semaphore bounding the books opened by aopen() on the running loop (Internal only)"""
+    import asyncio
+    loop = asyncio.get_running_loop()
+    limit = _asyncLimits.get(loop)
+    if limit is None:
+        limit = _asyncLimits[loop] = asyncio.Semaphore(_asyncMaxOpen)
+    return limit
+
+
+class _asyncOpen(object):
+    """result of aopen(), awaitable or usable with "async with" (Internal only)"""
+    def __init__(self, path, executor, options):
+        self.path = path
+        self.executor = executor
+        self.options = options
+        self.info = None
+
+    def __await__(self):
+        return self._open(False).__await__()
+
+    async def _open(self, hold):
+        import asyncio
+        limit = _asyncLimit()
+        await limit.acquire()
+        try:
+            future = _asyncRun(self.executor, epubInfo, self.path, **self.options)
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # the book still gets opened in the executor, close it once it is
+                future.add_done_callback(lambda done: done.exception() or done.result().close())
+                raise
+        except BaseException:
+            hold = False
+            raise
+        finally:
+            if not hold:
+                limit.release()
+
+    async def __aenter__(self):
+        self.info = await self._open(True)
+        return self.info
+
+    async def __aexit__(self, type, value, traceback):
+        try:
+            await self.info.aclose(self.executor)
+        finally:
+            _asyncLimit().release()
+
+
+def aopen(path, openFor="r", mode="full", cache=None, readCache=None, executor=None):
+    """open a book without blocking the event loop
+
+    "await aopen(path)" returns the epubInfo once it is read, "async with aopen(path) as info:" also closes it
+    and holds its open slot (see setAsyncExecutor) until then, which bounds the file descriptors in use
+    """
+    return _asyncOpen(path, executor, {"openFor": openFor, "mode": mode, "cache": cache, "readCache": readCache})
+
+
+def verify(path, workers=None, failFast=False):
+    """verifyReport of the book at path (or a buffer or file object), see epubInfo.verify"""
+    info = epubInfo(path, mode="verify")
+    try:
+        return info.verify(workers, failFast)
+    finally:
+        info.close()
+
+
+def _walkLibrary(root, extensions=(".epub",)):
+    """yield paths of books below root (Internal only)"""
+    for entry in _walkEntries(root, extensions):
+        yield entry.path
+
+
+def _walkEntries(root, extensions=(".epub",)):
+    """yield os.DirEntry objects of books below root (Internal only)"""
+    stack = [root]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except OSError:
+            continue
+        entries.sort(key=lambda entry: entry.name)
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif entry.name.lower().endswith(extensions):
+                yield entry
+
+
+def _scanBook(path, cache=None, timings=False, summary=False):
+    """metadata record for a single book, broken books give an error record (Internal only)"""
+    record = {"path": path, "meta": None, "error": None}
+    if timings:
+        record["timings"] = None
+    if summary:
+        record["summary"] = None
+    try:
+        book = epubFile(path, mode="summary" if summary else "meta", cache=cache)
+    except epubError as e:
+        record["error"] = str(e)
+        return record
+    except Exception as e:
+        record["error"] = "%s: %s" % (e.__class__.__name__, e)
+        return record
+    try:
+        record["meta"] = book.info.meta.getMetaData()
+        if summary:
+            record["summary"] = book.info.summary
+        if timings:
+            record["timings"] = book.info.stats.asDict()
+    finally:
+        book.info.close()
+    return record
+
+
+def _scanChunk(paths, cachePath=None, timings=False, summary=False):
+    """scan a chunk of books in a worker process (Internal only)"""
+    cache = metaCache(cachePath) if cachePath else None
+    try:
+        return [_scanBook(path, cache, timings, summary) for path in paths]
+    finally:
+        if cache:
+            cache.close()
+
+
+def scanLibrary(root, workers=None, chunksize=16, extensions=(".epub",), cachePath=None, timings=False, summary=False):
+    """scan every book below root in a process pool
+
+    yields metadata records ({"path", "meta", "error"}) as chunks finish, in no particular order.
+    workers defaults to the cpu count, workers=1 scans in this process. cachePath is an optional metaCache file.
+    with timings the records also hold the openStats.asDict() of the book (see statsAggregator),
+    with summary the manifest/spine summary of the OPF (epubInfo.summary)
+    """
+    return _scanPaths(_walkLibrary(root, extensions), workers, chunksize, cachePath, timings, summary)
+
+
+def _scanPaths(paths, workers=None, chunksize=16, cachePath=None, timings=False, summary=False):
+    """yield metadata records for paths, in a process pool unless workers is 1 (Internal only)"""
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        cache = metaCache(cachePath) if cachePath else None
+        try:
+            for path in paths:
+                yield _scanBook(path, cache, timings, summary)
+        finally:
+            if cache:
+                cache.close()
+        return
+
+    for record in _poolChunks(_scanChunk, paths, workers, chunksize, cachePath, timings, summary):
+        yield record
+
+
+def _poolChunks(func, paths, workers=None, chunksize=16, *args):
+    """yield the results of func(chunk, *args) over chunks of paths in a process pool, flattened (Internal only)"""
+    import concurrent.futures
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    def chunks():
+        chunk = []
+        for path in paths:
+            chunk.append(path)
+            if len(chunk) >= chunksize:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        # keep a bounded number of chunks in flight so huge libraries aren't queued up front
+        pending = set()
+        for chunk in chunks():
+            pending.add(executor.submit(func, chunk, *args))
+            if len(pending) >= workers * 2:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    for record in future.result():
+                        yield record
+        for future in concurrent.futures.as_completed(pending):
+            for record in future.result():
+                yield record
+
+
+def _archiveFingerprint(path):
+    """content hash of a book from its central directory, names, CRCs and sizes of every member but the mimetype (Internal only)
+
+    nothing is inflated, None if the file isn't a readable zip
+    """
+    import hashlib
+    try:
+        archive = zipfile.ZipFile(path, "r")
+    except Exception:
+        return None
+    try:
+        members = sorted((member.filename, member.CRC, member.file_size) for member in archive.infolist() if member.filename != "mimetype")
+    finally:
+        archive.close()
+    digest = hashlib.sha1()
+    for name, crc, size in members:
+        digest.update(("%s\0%08x\0%d\n" % (name, crc, size)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class bookFingerprint(object):
+    """content fingerprint of a book (see epubInfo.fingerprint)
+
+    digest is a hash of the OPF relative names, CRCs and sizes of the manifest items (None if the book couldn't be read,
+    then error says why). similarity() compares the contents only, ignoring names
+    """
+    def __init__(self, path, members=None, error=None):
+        self.path = path
+
+        # {opf relative href: (crc, size)}
+        self.members = members or {}
+        self.error = error
+        self.digest = None
+        if error is None:
+            import hashlib
+            digest = hashlib.sha1()
+            for name in sorted(self.members):
+                digest.update(("%s\0%08x\0%d\n" % ((name,) + self.members[name])).encode("utf-8"))
+            self.digest = digest.hexdigest()
+
+    @property
+    def size(self):
+        """total (uncompressed) size of the manifest items"""
+        return sum(size for crc, size in self.members.values())
+
+    def similarity(self, other):
+        """near duplicate score between 0.0 and 1.0, the share of bytes in identical items (size weighted jaccard)
+
+        items are matched by CRC and size, so renamed and moved items still count
+        """
+        if self.digest is not None and self.digest == other.digest:
+            return 1.0
+        ours = collections.Counter(self.members.values())
+        theirs = collections.Counter(other.members.values())
+        shared = sum(key[1] * count for key, count in (ours & theirs).items())
+        total = sum(key[1] * count for key, count in (ours | theirs).items())
+        if not total:
+            return 0.0
+        return shared / float(total)
+
+    def asDict(self):
+        return {"path": self.path, "digest": self.digest, "size": self.size, "items": len(self.members), "error": self.error}
+
+
+def fingerprint(path):
+    """bookFingerprint of the book at path (or a buffer or file object), see epubInfo.fingerprint"""
+    info = epubInfo(path, mode="meta")
+    try:
+        return info.fingerprint()
+    finally:
+        info.close()
+
+
+def _fingerprintBook(path):
+    """bookFingerprint of a book, broken books give one with an error (Internal only)"""
+    try:
+        return fingerprint(path)
+    except epubError as e:
+        return bookFingerprint(path, error=str(e))
+    except Exception as e:
+        return bookFingerprint(path, error="%s: %s" % (e.__class__.__name__, e))
+
+
+def _fingerprintChunk(paths):
+    """fingerprint a chunk of books in a worker process (Internal only)"""
+    return [_fingerprintBook(path) for path in paths]
+
+
+def fingerprintLibrary(root, workers=None, chunksize=16, extensions=(".epub",)):
+    """fingerprint every book below root in a process pool
+
+    yields bookFingerprints as chunks finish, in no particular order. only the OPFs are inflated.
+    workers defaults to the cpu count, workers=1 works in this process
+    """
+    paths = _walkLibrary(root, extensions)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        return (_fingerprintBook(path) for path in paths)
+    return _poolChunks(_fingerprintChunk, paths, workers, chunksize)
+
+
+def groupDuplicates(fingerprints, threshold=1.0, candidates=4):
+    """group fingerprints of the same book, returns a list of lists of bookFingerprints (groups of two or more)
+
+    with threshold 1.0 books are grouped by digest. with a lower threshold near duplicates (similarity() >= threshold)
+    are grouped too, transitively; books are only compared when they share one of their candidates largest items
+    """
+    fingerprints = [fp for fp in fingerprints if fp.digest is not None]
+
+    # union-find over fingerprint indexes, exact duplicates first
+    parents = list(range(len(fingerprints)))
+
+    def find(index):
+        while parents[index] != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+
+    byDigest = {}
+    for index, fp in enumerate(fingerprints):
+        if fp.digest in byDigest:
+            parents[find(index)] = find(byDigest[fp.digest])
+        else:
+            byDigest[fp.digest] = index
+
+    if threshold < 1.0:
+        # only one fingerprint per digest needs comparing
+        byItem = collections.defaultdict(list)
+        for index in byDigest.values():
+            fp = fingerprints[index]
+            for key in sorted(set(fp.members.values()), key=lambda key: -key[1])[:candidates]:
+                byItem[key].append(index)
+        compared = set()
+        for indexes in byItem.values():
+            for position, first in enumerate(indexes):
+                for second in indexes[position + 1:]:
+                    if (first, second) in compared or find(first) == find(second):
+                        continue
+                    compared.add((first, second))
+                    if fingerprints[first].similarity(fingerprints[second]) >= threshold:
+                        parents[find(second)] = find(first)
+
+    groups = collections.defaultdict(list)
+    for index, fp in enumerate(fingerprints):
+        groups[find(index)].append(fp)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+class libraryDelta(object):
+    """changes found by rescanLibrary"""
+    def __init__(self):
+        # records of new books
+        self.added = []
+
+        # paths of books that are gone
+        self.removed = []
+
+        # records of books whose content changed
+        self.modified = []
+
+        # (old path, new path) of moved books, matched by content fingerprint
+        self.renamed = []
+
+        # number of books that were left alone
+        self.unchanged = 0
+
+        # scan state to hand to the next rescanLibrary (path -> {"size", "mtime", "fingerprint", "record"})
+        self.state = {}
+
+
+def rescanLibrary(root, state=None, workers=1, chunksize=16, extensions=(".epub",), cachePath=None):
+    """rescan a library, only reparsing books that changed since state
+
+    books are stat'ed through os.scandir, only those whose size or mtime differ get their central
+    directory fingerprinted and only added or modified books are read through epubInfo.
+    returns a libraryDelta, its state is the input for the next rescan (see saveScanState)
+    """
+    state = state or {}
+    delta = libraryDelta()
+    seen = set()
+
+    # books that need a fingerprint to tell what happened to them
+    candidates = []
+    for entry in _walkEntries(root, extensions):
+        path = entry.path
+        seen.add(path)
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        old = state.get(path)
+        if old and old["size"] == stat.st_size and old["mtime"] == stat.st_mtime_ns:
+            delta.state[path] = old
+            delta.unchanged += 1
+        else:
+            candidates.append((path, stat))
+
+    # fingerprints of books that have disappeared, for rename detection
+    gone = {}
+    for path, old in state.items():
+        if path not in seen and old.get("fingerprint"):
+            gone.setdefault(old["fingerprint"], []).append(path)
+
+    reparse = {}
+    for path, stat in candidates:
+        fingerprint = _archiveFingerprint(path)
+        entry = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "fingerprint": fingerprint, "record": None}
+        old = state.get(path)
+        if old:
+            if fingerprint and old.get("fingerprint") == fingerprint:
+                # touched but not changed
+                entry["record"] = old["record"]
+                delta.unchanged += 1
+            else:
+                reparse[path] = "modified"
+        elif fingerprint in gone and gone[fingerprint]:
+            oldPath = gone[fingerprint].pop()
+            record = dict(state[oldPath]["record"] or {})
+            record["path"] = path
+            entry["record"] = record
+            delta.renamed.append((oldPath, path))
+        else:
+            reparse[path] = "added"
+        delta.state[path] = entry
+
+    renamedFrom = set(oldPath for oldPath, path in delta.renamed)
+    delta.removed = sorted(path for path in state if path not in seen and path not in renamedFrom)
+
+    for record in _scanPaths(sorted(reparse), workers, chunksize, cachePath):
+        delta.state[record["path"]]["record"] = record
+        if reparse[record["path"]] == "added":
+            delta.added.append(record)
+        else:
+            delta.modified.append(record)
+    return delta
+
+
+def saveScanState(state, path):
+    """write a rescanLibrary state to a JSON file"""
+    import json
+    with open(path, "w") as f:
+        json.dump(state, f)
+
+
+def loadScanState(path):
+    """read a rescanLibrary state from a JSON file (an empty state if there is none)"""
+    import json
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+# columns of exported records: path and error, the default META templates, then the OPF summary counts
+_exportColumns = ["path", "error"] + list(META.TEMPLATES) + ["manifest", "spine", "linear", "size", "toc"]
+_exportCounts = ("manifest", "spine", "linear", "size")
+_exportFormats = {".jsonl": "jsonl", ".csv": "csv", ".parquet": "parquet", ".arrow": "arrow", ".feather": "arrow"}
+
+
+def _exportRow(record, flat=True):
+    """row of _exportColumns from a scan record, flat rows join list values with "; " (Internal only)"""
+    row = {"path": record["path"], "error": record.get("error")}
+    meta = record.get("meta") or {}
+    for name in META.TEMPLATES:
+        value = meta.get(name)
+        if flat and isinstance(value, (list, tuple)):
+            value = "; ".join(str(part) for part in value if part is not None)
+        elif flat and value is not None:
+            value = str(value)
+        row[name] = value
+    summary = record.get("summary") or {}
+    row["manifest"] = summary.get("manifest")
+    row["spine"] = len(summary["spine"]) if summary.get("spine") is not None else None
+    row["linear"] = summary.get("linear")
+    row["size"] = summary.get("size")
+    row["toc"] = summary.get("toc")
+    return row
+
+
+class _jsonlWriter(object):
+    """JSON Lines export, list values are kept (Internal only)"""
+    flat = False
+
+    def __init__(self, out):
+        import json
+        self.out = out
+        self.dumps = json.dumps
+
+    def write(self, rows):
+        self.out.write("".join(self.dumps(row) + "\n" for row in rows))
+
+    def close(self):
+        pass
+
+
+class _csvWriter(object):
+    """CSV export with a header row (Internal only)"""
+    flat = True
+
+    def __init__(self, out):
+        import csv
+        self.writer = csv.writer(out)
+        self.writer.writerow(_exportColumns)
+
+    def write(self, rows):
+        self.writer.writerows([row[column] for column in _exportColumns] for row in rows)
+
+    def close(self):
+        pass
+
+
+class _arrowWriter(object):
+    """Arrow IPC file or Parquet export, one record batch per write (Internal only)"""
+    flat = True
+
+    def __init__(self, out, format):
+        import pyarrow
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([(column, pyarrow.int64() if column in _exportCounts else pyarrow.string())
+                                      for column in _exportColumns])
+        if format == "parquet":
+            import pyarrow.parquet
+            self.writer = pyarrow.parquet.ParquetWriter(out, self.schema)
+        else:
+            import pyarrow.ipc
+            self.writer = pyarrow.ipc.new_file(out, self.schema)
+
+    def write(self, rows):
+        batch = self.pyarrow.RecordBatch.from_pydict(dict((column, [row[column] for row in rows]) for column in _exportColumns),
+                                                     schema=self.schema)
+        self.writer.write_table(self.pyarrow.Table.from_batches([batch]))
+
+    def close(self):
+        self.writer.close()
+
+
+def exportRecords(records, out, format=None, batchSize=1024):
+    """write scan records (see scanLibrary) to out, a path or an open file, returns the number of records written
+
+    format is "jsonl", "csv", "parquet" or "arrow" (the last two need pyarrow), by default taken from the extension
+    of out (JSON Lines if there's none). records are written in batches of batchSize, so memory use doesn't grow
+    with the number of books. text formats need a text file, Arrow and Parquet a binary one
+    """
+    if format is None:
+        name = os.fspath(out) if isinstance(out, (str, os.PathLike)) else getattr(out, "name", "")
+        extension = os.path.splitext(str(name))[1].lower()
+        if extension == ".json":
+            raise epubError("'%s' would not hold a JSON document, use .jsonl or give the format" % name)
+        format = _exportFormats.get(extension, "jsonl")
+    if format not in ("jsonl", "csv", "parquet", "arrow"):
+        raise epubError("Unknown export format '%s'" % format)
+
+    binary = format in ("parquet", "arrow")
+    if binary:
+        # fail before the output file is created when pyarrow is missing
+        try:
+            import pyarrow
+        except ImportError:
+            raise epubError("exporting to %s needs pyarrow" % format)
+    opened = None
+    if isinstance(out, (str, os.PathLike)):
+        out = opened = open(out, "wb") if binary else open(out, "w", newline="", encoding="utf-8")
+    try:
+        if format == "jsonl":
+            writer = _jsonlWriter(out)
+        elif format == "csv":
+            writer = _csvWriter(out)
+        else:
+            writer = _arrowWriter(out, format)
+        count = 0
+        batch = []
+        for record in records:
+            batch.append(_exportRow(record, writer.flat))
+            if len(batch) >= batchSize:
+                writer.write(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            writer.write(batch)
+            count += len(batch)
+        writer.close()
+    finally:
+        if opened:
+            opened.close()
+    return count
+
+
+def exportLibrary(root, out, format=None, workers=None, chunksize=16, cachePath=None, batchSize=1024):
+    """scan every book below root (with OPF summaries) and stream the records to out, see exportRecords"""
+    records = scanLibrary(root, workers=workers, chunksize=chunksize, cachePath=cachePath, summary=True)
+    return exportRecords(records, out, format, batchSize)
+
+
+_tokenPattern = re.compile(r"\w+")
+
+
+def _tokens(text):
+    """(casefolded term, offset) of the words of text (Internal only)"""
+    for match in _tokenPattern.finditer(text):
+        yield match.group(0).casefold(), match.start()
+
+
+class textIndex(object):
+    """inverted full-text index of the spine text of books, see epubInfo.iterText
+
+    terms map to (book, item, position, offset) postings: position counts the words of the item (used by
+    phrase searches) and offset is the character offset in the plain text of the item.
+
+    the index saved by save() is memory mapped when opened, books added afterwards are kept in memory and
+    removed books are dropped from results until the next save() rewrites the file without them.
+
+    file layout (little endian): header, books as JSON, term table of (blob offset, length, first posting,
+    posting count) uint32s sorted by term, term blob (utf-8), postings of 4 uint32s.
+    """
+    MAGIC = b"EPIX"
+    VERSION = 1
+    _header = struct.Struct("<4sIIIII")
+    _entry = struct.Struct("<IIII")
+
+    def __init__(self, path=None):
+        self.path = path
+
+        # [path, [item rootRelLocs]] by book number, None for removed books
+        self.books = []
+
+        # path -> book number of the books in the index
+        self._bookIds = {}
+
+        # postings of books added since the index was loaded, term -> [(book, item, position, offset), ...]
+        self._added = {}
+
+        # the saved index
+        self._file = None
+        self._map = None
+        self._terms = 0
+        self._tableStart = self._blobStart = self._postingStart = 0
+
+        if path and os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        """memory map the saved index (Internal only)"""
+        import json
+        self._file = open(self.path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, booksLength, self._terms, blobLength, postings = self._header.unpack_from(self._map)
+        except (ValueError, struct.error):
+            self.close()
+            raise epubError("'%s' is not a text index" % self.path)
+        if magic != self.MAGIC or version != self.VERSION:
+            self.close()
+            raise epubError("'%s' is not a text index (or was written by another version)" % self.path)
+        start = self._header.size
+        self.books = json.loads(self._map[start:start + booksLength].decode("utf-8"))
+        self._tableStart = start + booksLength
+        self._blobStart = self._tableStart + self._terms * self._entry.size
+        self._postingStart = self._blobStart + blobLength
+        self._bookIds = dict((book[0], number) for number, book in enumerate(self.books) if book is not None)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._terms = 0
+
+    def __contains__(self, path):
+        return path in self._bookIds
+
+    def __len__(self):
+        return len(self._bookIds)
+
+    def addBook(self, path, linearOnly=False):
+        """index the spine text of the book at path (replacing it if it's already indexed)
+
+        the index is left untouched if the book can't be read
+        """
+        info = epubInfo(path)
+        try:
+            # postings are gathered apart and merged once the whole book has been read
+            items = []
+            postings = {}
+            for item in info.opf.spine:
+                if linearOnly and not item.linear:
+                    continue
+                items.append(item.rootRelLoc)
+                position = 0
+                for block in _itemText(item):
+                    for term, offset in _tokens(block.text):
+                        postings.setdefault(term, []).append((len(items) - 1, position, block.offset + offset))
+                        position += 1
+                    # keep phrases from matching across blocks
+                    position += 1
+        finally:
+            info.close()
+        self.removeBook(path)
+        number = len(self.books)
+        added = self._added
+        for term, occurrences in postings.items():
+            added.setdefault(term, []).extend((number,) + occurrence for occurrence in occurrences)
+        self.books.append([path, items])
+        self._bookIds[path] = number
+
+    def removeBook(self, path):
+        """drop the book at path from the index, True if it was indexed"""
+        number = self._bookIds.pop(path, None)
+        if number is None:
+            return False
+        self.books[number] = None
+        return True
+
+    def _term(self, index):
+        """term number index of the saved index (Internal only)"""
+        blobOffset, length, first, count = self._entry.unpack_from(self._map, self._tableStart + index * self._entry.size)
+        start = self._blobStart + blobOffset
+        return self._map[start:start + length], first, count
+
+    def _find(self, term):
+        """number of the first saved term >= term (Internal only)"""
+        low, high = 0, self._terms
+        while low < high:
+            middle = (low + high) // 2
+            if self._term(middle)[0] < term:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _savedTerms(self, prefix):
+        """(term, first posting, count) of the saved terms starting with prefix (Internal only)"""
+        key = prefix.encode("utf-8")
+        index = self._find(key)
+        while index < self._terms:
+            term, first, count = self._term(index)
+            if not term.startswith(key):
+                break
+            yield term.decode("utf-8"), first, count
+            index += 1
+
+    def _postings(self, term, prefix=False):
+        """live postings of term (or of every term starting with it) (Internal only)"""
+        books = self.books
+        result = []
+        for saved, first, count in self._savedTerms(term):
+            if not prefix and saved != term:
+                break
+            start = self._postingStart + first * self._entry.size
+            result.extend(posting for posting in self._entry.iter_unpack(self._map[start:start + count * self._entry.size])
+                          if books[posting[0]] is not None)
+        if prefix:
+            terms = [key for key in self._added if key.startswith(term)]
+        else:
+            terms = [term] if term in self._added else []
+        for key in terms:
+            result.extend(posting for posting in self._added[key] if books[posting[0]] is not None)
+        return result
+
+    def _hits(self, postings):
+        """sorted (book path, item rootRelLoc, offset) of postings (Internal only)"""
+        books = self.books
+        return sorted(set((books[book][0], books[book][1][item], offset) for book, item, position, offset in postings))
+
+    def terms(self, prefix=""):
+        """indexed terms starting with prefix"""
+        prefix = prefix.casefold()
+        found = set(term for term, first, count in self._savedTerms(prefix))
+        found.update(term for term in self._added if term.startswith(prefix))
+        return sorted(found)
+
+    def search(self, text):
+        """(book path, item rootRelLoc, offset) of the occurrences of the words of text as a phrase"""
+        terms = [term for term, offset in _tokens(text)]
+        if not terms:
+            return []
+        postings = self._postings(terms[0])
+        for distance, term in enumerate(terms[1:], 1):
+            if not postings:
+                break
+            following = set((book, item, position - distance) for book, item, position, offset in self._postings(term))
+            postings = [posting for posting in postings if posting[:3] in following]
+        return self._hits(postings)
+
+    def prefix(self, text):
+        """(book path, item rootRelLoc, offset) of the words starting with text"""
+        terms = [term for term, offset in _tokens(text)]
+        if len(terms) != 1:
+            return []
+        return self._hits(self._postings(terms[0], prefix=True))
+
+    def _mergedTerms(self):
+        """(utf-8 term, (first, count) of its saved postings or None, its added postings) of every term in byte order
+        (Internal only)"""
+        added = sorted((term.encode("utf-8"), term) for term in self._added)
+        index = position = 0
+        saved = self._term(0) if self._terms else None
+        while saved is not None or position < len(added):
+            addedKey = added[position][0] if position < len(added) else None
+            if saved is not None and (addedKey is None or saved[0] <= addedKey):
+                postings = ()
+                if saved[0] == addedKey:
+                    postings = self._added[added[position][1]]
+                    position += 1
+                yield saved[0], saved[1:], postings
+                index += 1
+                saved = self._term(index) if index < self._terms else None
+            else:
+                yield addedKey, None, self._added[added[position][1]]
+                position += 1
+
+    def save(self, path=None):
+        """write the book to path (back to its own file by default)
+
+        only items changed through write()/setMetaData() are recompressed, every other member is copied as raw
+        compressed bytes. the mimetype goes first and stored.
+        """
+        import tempfile
+        if self.openFor != "w":
+            raise epubError("'%s' was not opened for writing" % self._name())
+        if not self.archive:
+            raise epubError("'%s' has no archive to save" % self._name())
+        if not path and not self.path:
+            raise epubError("'%s' was not read from a file, save() needs a path" % self._name())
+        target = os.path.abspath(path) if path else self.path
+        inPlace = target == self.path
+        if inPlace:
+            fd, output = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(target))
+            os.close(fd)
+            os.chmod(output, os.stat(target).st_mode & 0o7777)
+        else:
+            output = target
+
+        items = sorted(self.contents.contents, key=lambda item: item.rootRelLoc != "mimetype")
+        try:
+            with zipfile.ZipFile(output, "w") as out:
+                for item in items:
+                    info = self.archive.getinfo(item.rootRelLoc)
+                    if item.rootRelLoc == "mimetype":
+                        if item.pending is None and info.compress_type == zipfile.ZIP_STORED:
+                            self._copyRaw(out, info)
+                        else:
+                            zinfo = zipfile.ZipInfo("mimetype", info.date_time)
+                            out.writestr(zinfo, item.read(), zipfile.ZIP_STORED)
+                    elif item.pending is not None:
+                        zinfo = zipfile.ZipInfo(item.rootRelLoc, time.localtime()[:6])
+                        zinfo.external_attr = info.external_attr
+                        out.writestr(zinfo, item.pending, zipfile.ZIP_DEFLATED)
+                    else:
+                        self._copyRaw(out, info)
+        except Exception:
+            if inPlace:
+                os.remove(output)
+            raise
+
+        if inPlace:
+            # swap the saved file in and reopen it under the existing items
+            self.contents.source.close()
+            self.archive.close()
+            os.replace(output, target)
+            self.archive = zipfile.ZipFile(target, "r")
+            self.contents.source = _zipSource(self.archive)
+            for item in self.contents.contents:
+                info = self.archive.getinfo(item.rootRelLoc)
+                item.archive = self.archive
+                item.pending = None
+                item.compressiontype = info.compress_type
+                item.compressed_size = info.compress_size
+                item.file_size = info.file_size
+                item.lastmodified = info.date_time
+        return target
+
+    def close(self):
+        # destory tempfiles when done
+        import shutil
+        if self.tmpLocation:
+            shutil.rmtree(self.tmpLocation)
+        if self.contents.source:
+            self.contents.source.close()
+        if self.archive:
+            self.archive.close()
+
+    async def aclose(self, executor=None):
+        """close() run in an executor"""
+        await _asyncRun(executor, self.close)
+
+    async def aspine(self, linearOnly=False, executor=None):
+        """async iterator of (item, content) over the spine, the next item is read while the current one is used"""
+        items = [item for item in self.opf.spine if item.linear or not linearOnly]
+        if not items:
+            return
+        pending = _asyncRun(executor, items[0].read)
+        try:
+            for index, item in enumerate(items):
+                data = await pending
+                pending = _asyncRun(executor, items[index + 1].read) if index + 1 < len(items) else None
+                yield item, data
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+
+class epubFile(object):
+    """docstring for epubFile"""
+    def __enter__(self, path=None, openFor="r"):
+        return self
+
+    def __init__(self, path=None, openFor="r", mode="full", cache=None):
+        self.path = path
+        self.info = epubInfo(self.path, openFor=openFor, mode=mode, cache=cache)
+        self.tmpLocation = None
+
+    def save(self, path=None):
+        """save changes (the book must be opened with openFor="w")"""
+        return self.info.save(path)
+
+    def __del__(self):
+        pass
+
+    def __exit__(self, type, value, traceback):
+        self.info.close()
+
+
+# elements of content documents whose links are prefetched along with the document (stylesheets, images ...)
+_resourcePattern = re.compile(rb"<(?:link|img|image|script|source|audio|video)(\s[^>]*)>", re.I)
+_resourceAttrs = frozenset((b"href", b"src", b"xlink:href"))
+
+
+class readingSession(object):
+    """reader of a book in spine order that prefetches what comes next
+
+    after every read the next `ahead` linear spine items, and then the stylesheets and images they link to,
+    are read on a background thread into a bounded itemCache, so the next page turn is usually served from memory
+    """
+    def __init__(self, info, ahead=2, maxBytes=32 * 1024 * 1024):
+        self.info = info
+        self.ahead = ahead
+        self.items = [item for item in info.opf.spine if item.linear]
+        self.positions = dict((item, index) for index, item in enumerate(self.items))
+
+        # prefetched contents
+        self.buffer = itemCache(maxBytes)
+
+        # index in items of the last read spine item (-1 before the first)
+        self.position = -1
+
+        # counters: reads served from the buffer, reads that weren't, items read by the background thread
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+
+        # items waiting to be prefetched and the one being read
+        self.queue = collections.deque()
+        self.loading = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name="epub prefetch", daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _schedule(self):
+        """queue the items following position (Internal only, the condition is held)"""
+        self.queue.clear()
+        for item in self.items[self.position + 1:self.position + 1 + self.ahead]:
+            if item.pending is None and item is not self.loading and item._cacheKey() not in self.buffer.entries:
+                self.queue.append(item)
+        self.condition.notify_all()
+
+    def _resources(self, item, data):
+        """items linked from a content document that aren't buffered yet (Internal only)"""
+        found = []
+        base = posixpath.dirname(item.rootRelLoc)
+        for tag in _resourcePattern.finditer(data):
+            for attr in _attrPattern.finditer(tag.group(1)):
+                if attr.group(1).lower() not in _resourceAttrs:
+                    continue
+                href = (attr.group(2) if attr.group(2) is not None else attr.group(3)).decode("utf-8", "replace")
+                if not href or href.startswith("#") or ":" in href.split("/", 1)[0]:
+                    continue
+                try:
+                    if "&" in href:
+                        import html
+                        href = html.unescape(href)
+                    linked = self.info.contents.getItemFromRoot(posixpath.join(base, href))
+                except epubError:
+                    continue
+                if linked is not item and not linked.spine and linked not in found and linked._cacheKey() not in self.buffer.entries:
+                    found.append(linked)
+        return found
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                item = self.loading = self.queue.popleft()
+            data = None
+            try:
+                data = item.read()
+                self.buffer.put(item._cacheKey(), data)
+            except Exception:
+                # read() in the caller's thread raises it again, the prefetching goes on
+                data = None
+            finally:
+                with self.condition:
+                    self.loading = None
+                    if data is not None:
+                        self.prefetched += 1
+                    self.condition.notify_all()
+
+            # the stylesheets and images of a chapter come before the chapters after it
+            if data is not None and item.spine:
+                try:
+                    resources = self._resources(item, data)
+                except Exception:
+                    resources = []
+                with self.condition:
+                    self.queue.extendleft(reversed(resources))
+                    self.condition.notify_all()
+
+    def read(self, item):
+        """content of item, from the buffer when it was prefetched, and prefetch what follows it"""
+        key = item._cacheKey()
+        with self.condition:
+            if self.closed:
+                raise epubError("The reading session is closed")
+            if item in self.positions:
+                self.position = self.positions[item]
+                self._schedule()
+
+            # being read right now, wait for it rather than reading it twice
+            while self.loading is item:
+                self.condition.wait()
+            data = self.buffer.get(key) if item.pending is None else None
+            if data is not None:
+                self.hits += 1
+                return data
+            self.misses += 1
+        data = item.read()
+        if item.spine:
+            resources = self._resources(item, data)
+            with self.condition:
+                self.queue.extendleft(reversed(resources))
+                self.condition.notify_all()
+        return data
+
+    def next(self):
+        """(item, content) of the linear spine item after the last one read, None at the end of the book"""
+        if self.position + 1 >= len(self.items):
+            return None
+        item = self.items[self.position + 1]
+        return item, self.read(item)
+
+    def seek(self, item):
+        """continue reading at item (prefetching starts from it)"""
+        with self.condition:
+            self.position = self.positions[item] - 1
+            self._schedule()
+
+    def stats(self):
+        """hits, misses, hit rate, prefetched items and buffer size"""
+        reads = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hitRate": float(self.hits) / reads if reads else 0.0,
+                "prefetched": self.prefetched, "bytes": self.buffer.size}
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.queue.clear()
+            self.condition.notify_all()
+        self.thread.join()
+        self.buffer.clear()
+
+
+def readMetadata(path, cache=None):
+    """read the metadata of an epub without linking any of its items
+
+    returns a dict of template name -> value, item references are left as the raw OPF references.
+    cache is an optional metaCache
+    """
+    info = epubInfo(path, mode="meta", cache=cache)
+    try:
+        return info.meta.getMetaData()
+    finally:
+        info.close()
+
+
+# executor running the blocking work of the asyncio API (None: the default executor of the loop) and the
+# number of books aopen() opens at once (or keeps open, when used with "async with") per event loop
+_asyncExecutor = None
+_asyncMaxOpen = 32
+_asyncLimits = weakref.WeakKeyDictionary()
+
+
+def setAsyncExecutor(executor=None, maxOpen=None):
+    """configure the executor and the open limit used by aopen(), epubItem.aread() and friends"""
+    global _asyncExecutor, _asyncMaxOpen
+    _asyncExecutor = executor
+    if maxOpen is not None:
+        _asyncMaxOpen = maxOpen
+        _asyncLimits.clear()
+
+
+def _asyncRun(executor, func, *args, **kwargs):
+    """asyncio future of func run in executor (Internal only)"""
+    import asyncio
+    loop = asyncio.get_running_loop()
+    if kwargs:
+        func = functools.partial(func, **kwargs)
+    return loop.run_in_executor(executor or _asyncExecutor, func, *args)
+
+
+def _asyncLimit():
+    """semaphore bounding the books opened by aopen() on the running loop (Internal only)"""
+    import asyncio
+    loop = asyncio.get_running_loop()
+    limit = _asyncLimits.get(loop)
+    if limit is None:
+        limit = _asyncLimits[loop] = asyncio.Semaphore(_asyncMaxOpen)
+    return limit
+
+
+class _asyncOpen(object):
+    """result of aopen(), awaitable or usable with "async with" (Internal only)"""
+    def __init__(self, path, executor, options):
+        self.path = path
+        self.executor = executor
+        self.options = options
+        self.info = None
+
+    def __await__(self):
+        return self._open(False).__await__()
+
+    async def _open(self, hold):
+        import asyncio
+        limit = _asyncLimit()
+        await limit.acquire()
+        try:
+            future = _asyncRun(self.executor, epubInfo, self.path, **self.options)
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # the book still gets opened in the executor, close it once it is
+                future.add_done_callback(lambda done: done.exception() or done.result().close())
+                raise
+        except BaseException:
+            hold = False
+            raise
+        finally:
+            if not hold:
+                limit.release()
+
+    async def __aenter__(self):
+        self.info = await self._open(True)
+        return self.info
+
+    async def __aexit__(self, type, value, traceback):
+        try:
+            await self.info.aclose(self.executor)
+        finally:
+            _asyncLimit().release()
+
+
+def aopen(path, openFor="r", mode="full", cache=None, readCache=None, executor=None):
+    """open a book without blocking the event loop
+
+    "await aopen(path)" returns the epubInfo once it is read, "async with aopen(path) as info:" also closes it
+    and holds its open slot (see setAsyncExecutor) until then, which bounds the file descriptors in use
+    """
+    return _asyncOpen(path, executor, {"openFor": openFor, "mode": mode, "cache": cache, "readCache": readCache})
+
+
+def verify(path, workers=None, failFast=False):
+    """verifyReport of the book at path (or a buffer or file object), see epubInfo.verify"""
+    info = epubInfo(path, mode="verify")
+    try:
+        return info.verify(workers, failFast)
+    finally:
+        info.close()
+
+
+def _walkLibrary(root, extensions=(".epub",)):
+    """yield paths of books below root (Internal only)"""
+    for entry in _walkEntries(root, extensions):
+        yield entry.path
+
+
+def _walkEntries(root, extensions=(".epub",)):
+    """yield os.DirEntry objects of books below root (Internal only)"""
+    stack = [root]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except OSError:
+            continue
+        entries.sort(key=lambda entry: entry.name)
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif entry.name.lower().endswith(extensions):
+                yield entry
+
+
+def _scanBook(path, cache=None, timings=False, summary=False):
+    """metadata record for a single book, broken books give an error record (Internal only)"""
+    record = {"path": path, "meta": None, "error": None}
+    if timings:
+        record["timings"] = None
+    if summary:
+        record["summary"] = None
+    try:
+        book = epubFile(path, mode="summary" if summary else "meta", cache=cache)
+    except epubError as e:
+        record["error"] = str(e)
+        return record
+    except Exception as e:
+        record["error"] = "%s: %s" % (e.__class__.__name__, e)
+        return record
+    try:
+        record["meta"] = book.info.meta.getMetaData()
+        if summary:
+            record["summary"] = book.info.summary
+        if timings:
+            record["timings"] = book.info.stats.asDict()
+    finally:
+        book.info.close()
+    return record
+
+
+def _scanChunk(paths, cachePath=None, timings=False, summary=False):
+    """scan a chunk of books in a worker process (Internal only)"""
+    cache = metaCache(cachePath) if cachePath else None
+    try:
+        return [_scanBook(path, cache, timings, summary) for path in paths]
+    finally:
+        if cache:
+            cache.close()
+
+
+def scanLibrary(root, workers=None, chunksize=16, extensions=(".epub",), cachePath=None, timings=False, summary=False):
+    """scan every book below root in a process pool
+
+    yields metadata records ({"path", "meta", "error"}) as chunks finish, in no particular order.
+    workers defaults to the cpu count, workers=1 scans in this process. cachePath is an optional metaCache file.
+    with timings the records also hold the openStats.asDict() of the book (see statsAggregator),
+    with summary the manifest/spine summary of the OPF (epubInfo.summary)
+    """
+    return _scanPaths(_walkLibrary(root, extensions), workers, chunksize, cachePath, timings, summary)
+
+
+def _scanPaths(paths, workers=None, chunksize=16, cachePath=None, timings=False, summary=False):
+    """yield metadata records for paths, in a process pool unless workers is 1 (Internal only)"""
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        cache = metaCache(cachePath) if cachePath else None
+        try:
+            for path in paths:
+                yield _scanBook(path, cache, timings, summary)
+        finally:
+            if cache:
+                cache.close()
+        return
+
+    for record in _poolChunks(_scanChunk, paths, workers, chunksize, cachePath, timings, summary):
+        yield record
+
+
+def _poolChunks(func, paths, workers=None, chunksize=16, *args):
+    """yield the results of func(chunk, *args) over chunks of paths in a process pool, flattened (Internal only)"""
+    import concurrent.futures
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    def chunks():
+        chunk = []
+        for path in paths:
+            chunk.append(path)
+            if len(chunk) >= chunksize:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        # keep a bounded number of chunks in flight so huge libraries aren't queued up front
+        pending = set()
+        for chunk in chunks():
+            pending.add(executor.submit(func, chunk, *args))
+            if len(pending) >= workers * 2:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    for record in future.result():
+                        yield record
+        for future in concurrent.futures.as_completed(pending):
+            for record in future.result():
+                yield record
+
+
+def _archiveFingerprint(path):
+    """content hash of a book from its central directory, names, CRCs and sizes of every member but the mimetype (Internal only)
+
+    nothing is inflated, None if the file isn't a readable zip
+    """
+    import hashlib
+    try:
+        archive = zipfile.ZipFile(path, "r")
+    except Exception:
+        return None
+    try:
+        members = sorted((member.filename, member.CRC, member.file_size) for member in archive.infolist() if member.filename != "mimetype")
+    finally:
+        archive.close()
+    digest = hashlib.sha1()
+    for name, crc, size in members:
+        digest.update(("%s\0%08x\0%d\n" % (name, crc, size)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class bookFingerprint(object):
+    """content fingerprint of a book (see epubInfo.fingerprint)
+
+    digest is a hash of the OPF relative names, CRCs and sizes of the manifest items (None if the book couldn't be read,
+    then error says why). similarity() compares the contents only, ignoring names
+    """
+    def __init__(self, path, members=None, error=None):
+        self.path = path
+
+        # {opf relative href: (crc, size)}
+        self.members = members or {}
+        self.error = error
+        self.digest = None
+        if error is None:
+            import hashlib
+            digest = hashlib.sha1()
+            for name in sorted(self.members):
+                digest.update(("%s\0%08x\0%d\n" % ((name,) + self.members[name])).encode("utf-8"))
+            self.digest = digest.hexdigest()
+
+    @property
+    def size(self):
+        """total (uncompressed) size of the manifest items"""
+        return sum(size for crc, size in self.members.values())
+
+    def similarity(self, other):
+        """near duplicate score between 0.0 and 1.0, the share of bytes in identical items (size weighted jaccard)
+
+        items are matched by CRC and size, so renamed and moved items still count
+        """
+        if self.digest is not None and self.digest == other.digest:
+            return 1.0
+        ours = collections.Counter(self.members.values())
+        theirs = collections.Counter(other.members.values())
+        shared = sum(key[1] * count for key, count in (ours & theirs).items())
+        total = sum(key[1] * count for key, count in (ours | theirs).items())
+        if not total:
+            return 0.0
+        return shared / float(total)
+
+    def asDict(self):
+        return {"path": self.path, "digest": self.digest, "size": self.size, "items": len(self.members), "error": self.error}
+
+
+def fingerprint(path):
+    """bookFingerprint of the book at path (or a buffer or file object), see epubInfo.fingerprint"""
+    info = epubInfo(path, mode="meta")
+    try:
+        return info.fingerprint()
+    finally:
+        info.close()
+
+
+def _fingerprintBook(path):
+    """bookFingerprint of a book, broken books give one with an error (Internal only)"""
+    try:
+        return fingerprint(path)
+    except epubError as e:
+        return bookFingerprint(path, error=str(e))
+    except Exception as e:
+        return bookFingerprint(path, error="%s: %s" % (e.__class__.__name__, e))
+
+
+def _fingerprintChunk(paths):
+    """fingerprint a chunk of books in a worker process (Internal only)"""
+    return [_fingerprintBook(path) for path in paths]
+
+
+def fingerprintLibrary(root, workers=None, chunksize=16, extensions=(".epub",)):
+    """fingerprint every book below root in a process pool
+
+    yields bookFingerprints as chunks finish, in no particular order. only the OPFs are inflated.
+    workers defaults to the cpu count, workers=1 works in this process
+    """
+    paths = _walkLibrary(root, extensions)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        return (_fingerprintBook(path) for path in paths)
+    return _poolChunks(_fingerprintChunk, paths, workers, chunksize)
+
+
+def groupDuplicates(fingerprints, threshold=1.0, candidates=4):
+    """group fingerprints of the same book, returns a list of lists of bookFingerprints (groups of two or more)
+
+    with threshold 1.0 books are grouped by digest. with a lower threshold near duplicates (similarity() >= threshold)
+    are grouped too, transitively; books are only compared when they share one of their candidates largest items
+    """
+    fingerprints = [fp for fp in fingerprints if fp.digest is not None]
+
+    # union-find over fingerprint indexes, exact duplicates first
+    parents = list(range(len(fingerprints)))
+
+    def find(index):
+        while parents[index] != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+
+    byDigest = {}
+    for index, fp in enumerate(fingerprints):
+        if fp.digest in byDigest:
+            parents[find(index)] = find(byDigest[fp.digest])
+        else:
+            byDigest[fp.digest] = index
+
+    if threshold < 1.0:
+        # only one fingerprint per digest needs comparing
+        byItem = collections.defaultdict(list)
+        for index in byDigest.values():
+            fp = fingerprints[index]
+            for key in sorted(set(fp.members.values()), key=lambda key: -key[1])[:candidates]:
+                byItem[key].append(index)
+        compared = set()
+        for indexes in byItem.values():
+            for position, first in enumerate(indexes):
+                for second in indexes[position + 1:]:
+                    if (first, second) in compared or find(first) == find(second):
+                        continue
+                    compared.add((first, second))
+                    if fingerprints[first].similarity(fingerprints[second]) >= threshold:
+                        parents[find(second)] = find(first)
+
+    groups = collections.defaultdict(list)
+    for index, fp in enumerate(fingerprints):
+        groups[find(index)].append(fp)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+class libraryDelta(object):
+    """changes found by rescanLibrary"""
+    def __init__(self):
+        # records of new books
+        self.added = []
+
+        # paths of books that are gone
+        self.removed = []
+
+        # records of books whose content changed
+        self.modified = []
+
+        # (old path, new path) of moved books, matched by content fingerprint
+        self.renamed = []
+
+        # number of books that were left alone
+        self.unchanged = 0
+
+        # scan state to hand to the next rescanLibrary (path -> {"size", "mtime", "fingerprint", "record"})
+        self.state = {}
+
+
+def rescanLibrary(root, state=None, workers=1, chunksize=16, extensions=(".epub",), cachePath=None):
+    """rescan a library, only reparsing books that changed since state
+
+    books are stat'ed through os.scandir, only those whose size or mtime differ get their central
+    directory fingerprinted and only added or modified books are read through epubInfo.
+    returns a libraryDelta, its state is the input for the next rescan (see saveScanState)
+    """
+    state = state or {}
+    delta = libraryDelta()
+    seen = set()
+
+    # books that need a fingerprint to tell what happened to them
+    candidates = []
+    for entry in _walkEntries(root, extensions):
+        path = entry.path
+        seen.add(path)
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        old = state.get(path)
+        if old and old["size"] == stat.st_size and old["mtime"] == stat.st_mtime_ns:
+            delta.state[path] = old
+            delta.unchanged += 1
+        else:
+            candidates.append((path, stat))
+
+    # fingerprints of books that have disappeared, for rename detection
+    gone = {}
+    for path, old in state.items():
+        if path not in seen and old.get("fingerprint"):
+            gone.setdefault(old["fingerprint"], []).append(path)
+
+    reparse = {}
+    for path, stat in candidates:
+        fingerprint = _archiveFingerprint(path)
+        entry = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "fingerprint": fingerprint, "record": None}
+        old = state.get(path)
+        if old:
+            if fingerprint and old.get("fingerprint") == fingerprint:
+                # touched but not changed
+                entry["record"] = old["record"]
+                delta.unchanged += 1
+            else:
+                reparse[path] = "modified"
+        elif fingerprint in gone and gone[fingerprint]:
+            oldPath = gone[fingerprint].pop()
+            record = dict(state[oldPath]["record"] or {})
+            record["path"] = path
+            entry["record"] = record
+            delta.renamed.append((oldPath, path))
+        else:
+            reparse[path] = "added"
+        delta.state[path] = entry
+
+    renamedFrom = set(oldPath for oldPath, path in delta.renamed)
+    delta.removed = sorted(path for path in state if path not in seen and path not in renamedFrom)
+
+    for record in _scanPaths(sorted(reparse), workers, chunksize, cachePath):
+        delta.state[record["path"]]["record"] = record
+        if reparse[record["path"]] == "added":
+            delta.added.append(record)
+        else:
+            delta.modified.append(record)
+    return delta
+
+
+def saveScanState(state, path):
+    """write a rescanLibrary state to a JSON file"""
+    import json
+    with open(path, "w") as f:
+        json.dump(state, f)
+
+
+def loadScanState(path):
+    """read a rescanLibrary state from a JSON file (an empty state if there is none)"""
+    import json
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+# columns of exported records: path and error, the default META templates, then the OPF summary counts
+_exportColumns = ["path", "error"] + list(META.TEMPLATES) + ["manifest", "spine", "linear", "size", "toc"]
+_exportCounts = ("manifest", "spine", "linear", "size")
+_exportFormats = {".jsonl": "jsonl", ".csv": "csv", ".parquet": "parquet", ".arrow": "arrow", ".feather": "arrow"}
+
+
+def _exportRow(record, flat=True):
+    """row of _exportColumns from a scan record, flat rows join list values with "; " (Internal only)"""
+    row = {"path": record["path"], "error": record.get("error")}
+    meta = record.get("meta") or {}
+    for name in META.TEMPLATES:
+        value = meta.get(name)
+        if flat and isinstance(value, (list, tuple)):
+            value = "; ".join(str(part) for part in value if part is not None)
+        elif flat and value is not None:
+            value = str(value)
+        row[name] = value
+    summary = record.get("summary") or {}
+    row["manifest"] = summary.get("manifest")
+    row["spine"] = len(summary["spine"]) if summary.get("spine") is not None else None
+    row["linear"] = summary.get("linear")
+    row["size"] = summary.get("size")
+    row["toc"] = summary.get("toc")
+    return row
+
+
+class _jsonlWriter(object):
+    """JSON Lines export, list values are kept (Internal only)"""
+    flat = False
+
+    def __init__(self, out):
+        import json
+        self.out = out
+        self.dumps = json.dumps
+
+    def write(self, rows):
+        self.out.write("".join(self.dumps(row) + "\n" for row in rows))
+
+    def close(self):
+        pass
+
+
+class _csvWriter(object):
+    """CSV export with a header row (Internal only)"""
+    flat = True
+
+    def __init__(self, out):
+        import csv
+        self.writer = csv.writer(out)
+        self.writer.writerow(_exportColumns)
+
+    def write(self, rows):
+        self.writer.writerows([row[column] for column in _exportColumns] for row in rows)
+
+    def close(self):
+        pass
+
+
+class _arrowWriter(object):
+    """Arrow IPC file or Parquet export, one record batch per write (Internal only)"""
+    flat = True
+
+    def __init__(self, out, format):
+        import pyarrow
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([(column, pyarrow.int64() if column in _exportCounts else pyarrow.string())
+                                      for column in _exportColumns])
+        if format == "parquet":
+            import pyarrow.parquet
+            self.writer = pyarrow.parquet.ParquetWriter(out, self.schema)
+        else:
+            import pyarrow.ipc
+            self.writer = pyarrow.ipc.new_file(out, self.schema)
+
+    def write(self, rows):
+        batch = self.pyarrow.RecordBatch.from_pydict(dict((column, [row[column] for row in rows]) for column in _exportColumns),
+                                                     schema=self.schema)
+        self.writer.write_table(self.pyarrow.Table.from_batches([batch]))
+
+    def close(self):
+        self.writer.close()
+
+
+def exportRecords(records, out, format=None, batchSize=1024):
+    """write scan records (see scanLibrary) to out, a path or an open file, returns the number of records written
+
+    format is "jsonl", "csv", "parquet" or "arrow" (the last two need pyarrow), by default taken from the extension
+    of out (JSON Lines if there's none). records are written in batches of batchSize, so memory use doesn't grow
+    with the number of books. text formats need a text file, Arrow and Parquet a binary one
+    """
+    if format is None:
+        name = os.fspath(out) if isinstance(out, (str, os.PathLike)) else getattr(out, "name", "")
+        extension = os.path.splitext(str(name))[1].lower()
+        if extension == ".json":
+            raise epubError("'%s' would not hold a JSON document, use .jsonl or give the format" % name)
+        format = _exportFormats.get(extension, "jsonl")
+    if format not in ("jsonl", "csv", "parquet", "arrow"):
+        raise epubError("Unknown export format '%s'" % format)
+
+    binary = format in ("parquet", "arrow")
+    if binary:
+        # fail before the output file is created when pyarrow is missing
+        try:
+            import pyarrow
+        except ImportError:
+            raise epubError("exporting to %s needs pyarrow" % format)
+    opened = None
+    if isinstance(out, (str, os.PathLike)):
+        out = opened = open(out, "wb") if binary else open(out, "w", newline="", encoding="utf-8")
+    try:
+        if format == "jsonl":
+            writer = _jsonlWriter(out)
+        elif format == "csv":
+            writer = _csvWriter(out)
+        else:
+            writer = _arrowWriter(out, format)
+        count = 0
+        batch = []
+        for record in records:
+            batch.append(_exportRow(record, writer.flat))
+            if len(batch) >= batchSize:
+                writer.write(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            writer.write(batch)
+            count += len(batch)
+        writer.close()
+    finally:
+        if opened:
+            opened.close()
+    return count
+
+
+def exportLibrary(root, out, format=None, workers=None, chunksize=16, cachePath=None, batchSize=1024):
+    """scan every book below root (with OPF summaries) and stream the records to out, see exportRecords"""
+    records = scanLibrary(root, workers=workers, chunksize=chunksize, cachePath=cachePath, summary=True)
+    return exportRecords(records, out, format, batchSize)
+
+
+_tokenPattern = re.compile(r"\w+")
+
+
+def _tokens(text):
+    """(casefolded term, offset) of the words of text (Internal only)"""
+    for match in _tokenPattern.finditer(text):
+        yield match.group(0).casefold(), match.start()
+
+
+class textIndex(object):
+    """inverted full-text index of the spine text of books, see epubInfo.iterText
+
+    terms map to (book, item, position, offset) postings: position counts the words of the item (used by
+    phrase searches) and offset is the character offset in the plain text of the item.
+
+    the index saved by save() is memory mapped when opened, books added afterwards are kept in memory and
+    removed books are dropped from results until the next save() rewrites the file without them.
+
+    file layout (little endian): header, books as JSON, term table of (blob offset, length, first posting,
+    posting count) uint32s sorted by term, term blob (utf-8), postings of 4 uint32s.
+    """
+    MAGIC = b"EPIX"
+    VERSION = 1
+    _header = struct.Struct("<4sIIIII")
+    _entry = struct.Struct("<IIII")
+
+    def __init__(self, path=None):
+        self.path = path
+
+        # [path, [item rootRelLocs]] by book number, None for removed books
+        self.books = []
+
+        # path -> book number of the books in the index
+        self._bookIds = {}
+
+        # postings of books added since the index was loaded, term -> [(book, item, position, offset), ...]
+        self._added = {}
+
+        # the saved index
+        self._file = None
+        self._map = None
+        self._terms = 0
+        self._tableStart = self._blobStart = self._postingStart = 0
+
+        if path and os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        """memory map the saved index (Internal only)"""
+        import json
+        self._file = open(self.path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, booksLength, self._terms, blobLength, postings = self._header.unpack_from(self._map)
+        except (ValueError, struct.error):
+            self.close()
+            raise epubError("'%s' is not a text index" % self.path)
+        if magic != self.MAGIC or version != self.VERSION:
+            self.close()
+            raise epubError("'%s' is not a text index (or was written by another version)" % self.path)
+        start = self._header.size
+        self.books = json.loads(self._map[start:start + booksLength].decode("utf-8"))
+        self._tableStart = start + booksLength
+        self._blobStart = self._tableStart + self._terms * self._entry.size
+        self._postingStart = self._blobStart + blobLength
+        self._bookIds = dict((book[0], number) for number, book in enumerate(self.books) if book is not None)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._terms = 0
+
+    def __contains__(self, path):
+        return path in self._bookIds
+
+    def __len__(self):
+        return len(self._bookIds)
+
+    def addBook(self, path, linearOnly=False):
+        """index the spine text of the book at path (replacing it if it's already indexed)
+
+        the index is left untouched if the book can't be read
+        """
+        info = epubInfo(path)
+        try:
+            # postings are gathered apart and merged once the whole book has been read
+            items = []
+            postings = {}
+            for item in info.opf.spine:
+                if linearOnly and not item.linear:
+                    continue
+                items.append(item.rootRelLoc)
+                position = 0
+                for block in _itemText(item):
+                    for term, offset in _tokens(block.text):
+                        postings.setdefault(term, []).append((len(items) - 1, position, block.offset + offset))
+                        position += 1
+                    # keep phrases from matching across blocks
+                    position += 1
+        finally:
+            info.close()
+        self.removeBook(path)
+        number = len(self.books)
+        added = self._added
+        for term, occurrences in postings.items():
+            added.setdefault(term, []).extend((number,) + occurrence for occurrence in occurrences)
+        self.books.append([path, items])
+        self._bookIds[path] = number
+
+    def removeBook(self, path):
+        """drop the book at path from the index, True if it was indexed"""
+        number = self._bookIds.pop(path, None)
+        if number is None:
+            return False
+        self.books[number] = None
+        return True
+
+    def _term(self, index):
+        """term number index of the saved index (Internal only)"""
+        blobOffset, length, first, count = self._entry.unpack_from(self._map, self._tableStart + index * self._entry.size)
+        start = self._blobStart + blobOffset
+        return self._map[start:start + length], first, count
+
+    def _find(self, term):
+        """number of the first saved term >= term (Internal only)"""
+        low, high = 0, self._terms
+        while low < high:
+            middle = (low + high) // 2
+            if self._term(middle)[0] < term:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _savedTerms(self, prefix):
+        """(term, first posting, count) of the saved terms starting with prefix (Internal only)"""
+        key = prefix.encode("utf-8")
+        index = self._find(key)
+        while index < self._terms:
+            term, first, count = self._term(index)
+            if not term.startswith(key):
+                break
+            yield term.decode("utf-8"), first, count
+            index += 1
+
+    def _postings(self, term, prefix=False):
+        """live postings of term (or of every term starting with it) (Internal only)"""
+        books = self.books
+        result = []
+        for saved, first, count in self._savedTerms(term):
+            if not prefix and saved != term:
+                break
+            start = self._postingStart + first * self._entry.size
+            result.extend(posting for posting in self._entry.iter_unpack(self._map[start:start + count * self._entry.size])
+                          if books[posting[0]] is not None)
+        if prefix:
+            terms = [key for key in self._added if key.startswith(term)]
+        else:
+            terms = [term] if term in self._added else []
+        for key in terms:
+            result.extend(posting for posting in self._added[key] if books[posting[0]] is not None)
+        return result
+
+    def _hits(self, postings):
+        """sorted (book path, item rootRelLoc, offset) of postings (Internal only)"""
+        books = self.books
+        return sorted(set((books[book][0], books[book][1][item], offset) for book, item, position, offset in postings))
+
+    def terms(self, prefix=""):
+        """indexed terms starting with prefix"""
+        prefix = prefix.casefold()
+        found = set(term for term, first, count in self._savedTerms(prefix))
+        found.update(term for term in self._added if term.startswith(prefix))
+        return sorted(found)
+
+    def search(self, text):
+        """(book path, item rootRelLoc, offset) of the occurrences of the words of text as a phrase"""
+        terms = [term for term, offset in _tokens(text)]
+        if not terms:
+            return []
+        postings = self._postings(terms[0])
+        for distance, term in enumerate(terms[1:], 1):
+            if not postings:
+                break
+            following = set((book, item, position - distance) for book, item, position, offset in self._postings(term))
+            postings = [posting for posting in postings if posting[:3] in following]
+        return self._hits(postings)
+
+    def prefix(self, text):
+        """(book path, item rootRelLoc, offset) of the words starting with text"""
+        terms = [term for term, offset in _tokens(text)]
+        if len(terms) != 1:
+            return []
+        return self._hits(self._postings(terms[0], prefix=True))
+
+    def _mergedTerms(self):
+        """(utf-8 term, (first, count) of its saved postings or None, its added postings) of every term in byte order
+        (Internal only)"""
+        added = sorted((term.encode("utf-8"), term) for term in self._added)
+        index = position = 0
+        while index < self._terms or position < len(added):
+            savedKey = self._term(index)[0] if index < self._terms else None
+            addedKey = added[position][0] if position < len(added) else None
+            if addedKey is None or (savedKey is not None and savedKey < addedKey):
+                term, first, count = self._term(index)
+                index += 1
+                yield term, (first, count), ()
+            elif savedKey is None or addedKey < savedKey:
+                position += 1
+                yield addedKey, None, self._added[added[position - 1][1]]
+            else:
+                term, first, count = self._term(index)
+                index += 1
+                position += 1
+                yield term, (first, count), self._added[added[position - 1][1]]
+
+    def save(self, path=None):
+        """write the index (without removed books) and map it, the file is replaced atomically
+
+        saved and added postings are merged a term at a time, memory use doesn't grow with the size of the index
+        """
+        import json
+        import shutil
+        import tempfile
+        path = path or self.path
+        if not path:
+            raise epubError("No path to save the text index to")
+
+        # renumber the books that are still indexed
+        renumber = {}
+        books = []
+        for number, book in enumerate(self.books):
+            if book is not None:
+                renumber[number] = len(books)
+                books.append(book)
+
+        booksData = json.dumps(books).encode("utf-8")
+        directory = os.path.dirname(os.path.abspath(path))
+        entry = self._entry
+        handle, temp = tempfile.mkstemp(prefix=".epix-", dir=directory)
+        try:
+            # the saved terms are sorted, they are merged with the sorted added terms a term at a time. the table, blob
+            # and postings are spilled to temporary files as they go and copied after the header once counted
+            with os.fdopen(handle, "wb") as out, tempfile.TemporaryFile(dir=directory) as tableFile, \
+                    tempfile.TemporaryFile(dir=directory) as blobFile, tempfile.TemporaryFile(dir=directory) as postingFile:
+                terms = blobLength = postingCount = 0
+                pending = []
+                for key, saved, added in self._mergedTerms():
+                    count = 0
+                    if saved is not None:
+                        first, total = saved
+                        start = self._postingStart + first * entry.size
+                        for book, item, position, offset in entry.iter_unpack(self._map[start:start + total * entry.size]):
+                            if book in renumber:
+                                pending.append(entry.pack(renumber[book], item, position, offset))
+                                count += 1
+                    for book, item, position, offset in added:
+                        if book in renumber:
+                            pending.append(entry.pack(renumber[book], item, position, offset))
+                            count += 1
+                    if len(pending) >= 65536:
+                        postingFile.write(b"".join(pending))
+                        pending = []
+                    if not count:
+                        continue
+                    tableFile.write(entry.pack(blobLength, len(key), postingCount, count))
+                    blobFile.write(key)
+                    blobLength += len(key)
+                    terms += 1
+                    postingCount += count
+                postingFile.write(b"".join(pending))
+
+                out.write(self._header.pack(self.MAGIC, self.VERSION, len(booksData), terms, blobLength, postingCount))
+                out.write(booksData)
+                for part in (tableFile, blobFile, postingFile):
+                    part.seek(0)
+                    shutil.copyfileobj(part, out)
+            self.close()
+            os.replace(temp, path)
+        except:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+        self.path = path
+        self._added = {}
+        self._load()
+
+    def stats(self):
+        return {"books": len(self._bookIds), "terms": self._terms, "addedTerms": len(self._added),
+                "bytes": len(self._map) if self._map is not None else 0}
+
+
+def main(argv=None):
+    """command line entry point"""
+    import json
+    import argparse
+    parser = argparse.ArgumentParser(prog="epub.py", description="epub module tools")
+    commands = parser.add_subparsers(dest="command")
+    scan = commands.add_parser("scan", help="print metadata records of every book below a directory as JSON lines")
+    scan.add_argument("root")
+    scan.add_argument("-w", "--workers", type=int, default=None, help="worker processes (default: cpu count)")
+    scan.add_argument("-c", "--chunksize", type=int, default=16, help="books per worker task")
+    scan.add_argument("--cache", default=None, help="metadata cache file")
+    scan.add_argument("--timings", action="store_true", help="add per phase timings to the records and print percentiles to stderr")
+    rescan = commands.add_parser("rescan", help="print the books added, removed, modified or renamed since the last rescan as JSON lines")
+    rescan.add_argument("root")
+    rescan.add_argument("state", help="scan state file, updated in place")
+    rescan.add_argument("-w", "--workers", type=int, default=1, help="worker processes for reparsing changed books")
+    rescan.add_argument("--cache", default=None, help="metadata cache file")
+    check = commands.add_parser("verify", help="print a verification report of every book as JSON lines (exit status 1 if any has errors)")
+    check.add_argument("paths", nargs="+")
+    check.add_argument("-w", "--workers", type=int, default=None, help="threads checking CRCs")
+    check.add_argument("--fail-fast", action="store_true", help="stop checking a book at its first error")
+    dupes = commands.add_parser("dupes", help="print groups of duplicate books below a directory as JSON lines")
+    dupes.add_argument("root")
+    dupes.add_argument("-w", "--workers", type=int, default=None, help="worker processes (default: cpu count)")
+    dupes.add_argument("-t", "--threshold", type=float, default=1.0, help="minimum similarity of near duplicates (default: exact only)")
+    export = commands.add_parser("export", help="write metadata records of every book below a directory to a JSON Lines, CSV, Parquet or Arrow file")
+    export.add_argument("root")
+    export.add_argument("output", help="output file, - for JSON Lines (or CSV with -f csv) on stdout")
+    export.add_argument("-f", "--format", choices=("jsonl", "csv", "parquet", "arrow"), default=None, help="default: from the output extension")
+    export.add_argument("-w", "--workers", type=int, default=None, help="worker processes (default: cpu count)")
+    export.add_argument("-c", "--chunksize", type=int, default=16, help="books per worker task")
+    export.add_argument("-b", "--batch", type=int, default=1024, help="records per write")
+    export.add_argument("--cache", default=None, help="metadata cache file")
+    index = commands.add_parser("index", help="add (or refresh) the books below a directory in a full-text index")
+    index.add_argument("root")
+    index.add_argument("index", help="text index file, updated in place")
+    index.add_argument("-b", "--batch", type=int, default=256, help="books indexed between saves")
+    search = commands.add_parser("search", help="print the occurrences of a phrase (or of words starting with it) as JSON lines")
+    search.add_argument("index", help="text index file")
+    search.add_argument("text")
+    search.add_argument("-p", "--prefix", action="store_true", help="search words starting with text")
+    args = parser.parse_args(argv)
+
+    if args.command == "scan":
+        aggregator = statsAggregator()
+        for record in scanLibrary(args.root, workers=args.workers, chunksize=args.chunksize, cachePath=args.cache, timings=args.timings):
+            aggregator.addRecord(record)
+            sys.stdout.write(json.dumps(record) + "\n")
+        if args.timings:
+            sys.stderr.write(json.dumps({"percentiles": aggregator.export(), "slowest": aggregator.slowest()}) + "\n")
+        return 0
+    if args.command == "rescan":
+        delta = rescanLibrary(args.root, loadScanState(args.state), workers=args.workers, cachePath=args.cache)
+        for record in delta.added:
+            sys.stdout.write(json.dumps({"change": "added", "path": record["path"], "record": record}) + "\n")
+        for record in delta.modified:
+            sys.stdout.write(json.dumps({"change": "modified", "path": record["path"], "record": record}) + "\n")
+        for oldPath, path in delta.renamed:
+            sys.stdout.write(json.dumps({"change": "renamed", "path": path, "from": oldPath}) + "\n")
+        for path in delta.removed:
+            sys.stdout.write(json.dumps({"change": "removed", "path": path}) + "\n")
+        saveScanState(delta.state, args.state)
+        return 0
+    if args.command == "verify":
+        status = 0
+        for path in args.paths:
+            report = verify(path, workers=args.workers, failFast=args.fail_fast)
+            sys.stdout.write(json.dumps(report.asDict()) + "\n")
+            if not report.ok:
+                status = 1
+        return status
+    if args.command == "dupes":
+        for group in groupDuplicates(fingerprintLibrary(args.root, workers=args.workers), args.threshold):
+            sys.stdout.write(json.dumps([fp.asDict() for fp in group]) + "\n")
+        return 0
+    if args.command == "export":
+        output = sys.stdout if args.output == "-" else args.output
+        try:
+            count = exportLibrary(args.root, output, args.format, workers=args.workers, chunksize=args.chunksize,
+                                  cachePath=args.cache, batchSize=args.batch)
+        except epubError as e:
+            sys.stderr.write("%s\n" % e)
+            return 1
+        sys.stderr.write("%d records\n" % count)
+        return 0
+    if args.command == "index":
+        fullText = textIndex(args.index)
+        added = 0
+        for path in _walkLibrary(args.root):
+            try:
+                fullText.addBook(path)
+            except epubError as e:
+                sys.stderr.write("%s: %s\n" % (path, e))
+                continue
+            added += 1
+            # save as we go so the books added in memory stay bounded
+            if added % args.batch == 0:
+                fullText.save()
+        fullText.save()
+        return 0
+    if args.command == "search":
+        fullText = textIndex(args.index)
+        for path, item, offset in (fullText.prefix(args.text) if args.prefix else fullText.search(args.text)):
+            sys.stdout.write(json.dumps({"path": path, "item": item, "offset": offset}) + "\n")
+        return 0
+    parser.print_help()
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
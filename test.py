@@ -53,7 +53,65 @@ print(metadata.getMetaData("date"))
 print(metadata.getMetaData("datepub"))
 print(metadata.getMetaData("datemod"))
 
+#meta data test5
+#print(metadata.getMetaData("title", "author", "identifer", "language"))
+
 
 #id finder test
-#test.info.findIDreferences("navPoint-6")
-#test.info.findIDreferences()
\ No newline at end of file
+#print(test.info.findIDreferences("navPoint-6"))
+#print(test.info.findIDreferences())
+#print(test.info.getIdIndex().dangling)
+#metadata only test
+#print(epub.readMetadata(os.path.join(os.path.dirname(__file__), "test_files/sample_file.epub")))
+
+#chunked read test
+#for chunk in test.info.opf.spine[0].iterChunks(1024):
+#    print(len(chunk))
+
+#table of contents test
+#for entry in test.info.ncx:
+#    print("  " * entry.depth + entry.label)
+#print(test.info.ncx.locate(test.info.opf.spine[3]).label)
+
+#text extraction test
+#for block in test.info.iterText(linearOnly=True):
+#    print(block.item.rootRelLoc, block.anchor, block.offset, block.text)
+
+#full-text index test
+#index = epub.textIndex("/tmp/books.epix")
+#index.addBook(os.path.join(os.path.dirname(__file__), "test_files/sample_file.epub"))
+#index.save()
+#print(index.search("lorem ipsum"))
+#print(index.prefix("chap"))
+
+#asyncio test
+#import asyncio
+#async def asyncTest():
+#    async with epub.aopen(os.path.join(os.path.dirname(__file__), "test_files/sample_file.epub")) as info:
+#        async for item, data in info.aspine():
+#            print(item.rootRelLoc, len(data))
+#asyncio.run(asyncTest())
+
+#reading session test
+#with epub.readingSession(test.info, ahead=2) as session:
+#    while session.next():
+#        pass
+#    print(session.stats())
+
+#open from memory test
+#with open(os.path.join(os.path.dirname(__file__), "test_files/sample_file.epub"), "rb") as f:
+#    print(epub.readMetadata(f.read()))
+
+#open timings test
+#print(test.info.stats.asDict())
+
+#verify test
+#report = epub.verify(os.path.join(os.path.dirname(__file__), "test_files/broken_file_container.epub"))
+#print(report.ok, report.problems)
+
+#fingerprint test
+#print(epub.fingerprint(os.path.join(os.path.dirname(__file__), "test_files/sample_file.epub")).asDict())
+#print([[fp.path for fp in group] for group in epub.groupDuplicates(epub.fingerprintLibrary(os.path.dirname(__file__)), 0.9)])
+
+#export test
+#print(epub.exportLibrary(os.path.join(os.path.dirname(__file__), "test_files"), "library.csv"))